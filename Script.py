@@ -26,6 +26,7 @@ class script(object):
 🤑 Premium Users: <code>{}</code>
 ✨ Used Storage: <code>{}</code>
 🗳 Free Storage: <code>{}</code>
+🔎 Search Cache: <code>{}</code> hits / <code>{}</code> misses
 🚀 Bot Uptime: <code>{}</code></b>"""
 
     NEW_GROUP_TXT = """<b>#NewGroup
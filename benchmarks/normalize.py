@@ -0,0 +1,45 @@
+"""Per-file cost of the caption normalization done while indexing.
+
+Run from the repository root:
+
+    python -m benchmarks.normalize
+"""
+import re
+import timeit
+
+from database.ia_filterdb import replacements, normalize_caption
+
+CAPTIONS = [
+    "@Movies_Dayz - Leo (2023) Tam + Tel + Hin Org Auds 1080p WEB-DL x264.mkv",
+    "Jailer.2023.1080p.HQ.HDRip.Tam.Mal.Kan.Aud.x264.mkv",
+    "Parasite (2019) Kor Eng Chi Subs 720p BluRay.mp4",
+    "@Star_Moviess_Tamil - Vikram 2022 Original Audios [Tamil + Telugu] HDRip.mkv",
+    "The.Office.S05E12.720p.WEB-DL.Eng.mkv",
+]
+RUNS = 20000
+
+# The list of (pattern, replacement) pairs applied one re.sub at a time
+sequential = [(r"\b%s\b" % abbreviation, expansion) for abbreviation, expansion in replacements.items()]
+
+def sequential_caption(caption):
+    file_name = re.sub(r"^@\w+ - ", "", str(caption))
+    file_caption = str(caption)
+    for pattern, replacement in sequential:
+        file_name = re.sub(pattern, replacement, file_name)
+        file_caption = re.sub(pattern, replacement, file_caption)
+    return file_name, file_caption
+
+def bench(func):
+    seconds = min(timeit.repeat(lambda: [func(caption) for caption in CAPTIONS], number=RUNS // len(CAPTIONS), repeat=5))
+    per_file = seconds / RUNS * 1e6
+    return per_file, 1e6 / per_file
+
+def main():
+    for caption in CAPTIONS:
+        assert normalize_caption(caption) == sequential_caption(caption), caption
+    for name, func in (("sequential re.sub", sequential_caption), ("compiled pipeline", normalize_caption)):
+        per_file, rate = bench(func)
+        print(f"{name:<18} {per_file:7.2f} us/file  {rate:>10,.0f} files/s")
+
+if __name__ == "__main__":
+    main()
@@ -12,13 +12,15 @@ from aiohttp import web
 
 # local imports
 from web import web_app
-from info import LOG_CHANNEL, API_ID, API_HASH, BOT_TOKEN, PORT, BIN_CHANNEL, ADMINS, DATABASE_URL, TAMILMV_LOG, TAMILBLAST_LOG
-from utils import temp, get_readable_time
+from web.worker import start_stream_workers, stop_stream_workers
+from info import LOG_CHANNEL, API_ID, API_HASH, BOT_TOKEN, PORT, BIN_CHANNEL, ADMINS, DATABASE_URL, TAMILMV_LOG, TAMILBLAST_LOG, STREAM_WORKERS, IMDB_CACHE_TTL, SEARCH_SESSION_DB, SEARCH_SESSION_TTL, SHORTLINK_CACHE_TTL
+from utils import temp, get_readable_time, watch_settings
 from plugins.scrapper.tools.rss_feed import tamilmv_rss_feed, tamilblasters_rss_feed
+from plugins.index import start_index_jobs
 
 # pymongo and database imports
 from database.users_chats_db import db
-from database.ia_filterdb import Media
+from database.ia_filterdb import Media, update_search_index
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 
@@ -89,18 +91,34 @@ class Bot(Client):
             # Set bot info in temp
             temp.BOT = self
             await Media.ensure_indexes()
+            try:
+                await db.create_imdb_index(IMDB_CACHE_TTL)
+                if SEARCH_SESSION_DB:
+                    await db.create_search_session_index(SEARCH_SESSION_TTL)
+                await db.create_shortlink_index(SHORTLINK_CACHE_TTL)
+            except Exception as e:
+                logger.error(f"Failed to create the cache indexes: {e}")
+            asyncio.create_task(update_search_index())
+            asyncio.create_task(watch_settings())
             me = await self.get_me()
             temp.ME = me.id
             temp.U_NAME = me.username
             temp.B_NAME = me.first_name
             
             logger.info(f"🤖 Bot Started: @{me.username}")
+
+            # Resume interrupted and queued indexing jobs
+            start_index_jobs(self)
             
-            # Start web server
-            app = web.AppRunner(web_app)
-            await app.setup()
-            await web.TCPSite(app, "0.0.0.0", PORT).start()
-            logger.info(f"🌐 Web server started on port {PORT}")
+            # Start web server, in separate processes when stream workers are configured
+            if STREAM_WORKERS:
+                # The workers log in with this session instead of authorizing the bot token again
+                start_stream_workers(await self.export_session_string())
+            else:
+                app = web.AppRunner(web_app)
+                await app.setup()
+                await web.TCPSite(app, "0.0.0.0", PORT).start()
+                logger.info(f"🌐 Web server started on port {PORT}")
             
             # Verify LOG_CHANNEL access
             try:
@@ -148,6 +166,11 @@ class Bot(Client):
             logger.error(f"❌ Error during bot startup: {e}", exc_info=True)
             raise
 
+    async def stop(self, *args, **kwargs):
+        # The workers would otherwise keep serving PORT with a session of a stopped bot
+        await stop_stream_workers()
+        await super().stop(*args, **kwargs)
+
 async def main():
     bot = Bot()
     
@@ -1,31 +1,52 @@
 import logging
 from struct import pack
 import re
+import time
 import base64
+import hashlib
 from pyrogram.file_id import FileId
-from pymongo.errors import DuplicateKeyError
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from umongo import Instance, Document, fields
 from motor.motor_asyncio import AsyncIOMotorClient
 from marshmallow.exceptions import ValidationError
-from info import DATABASE_URL, DATABASE_NAME, COLLECTION_NAME, MAX_BTN
+from info import DATABASE_URL, DATABASE_NAME, COLLECTION_NAME, MAX_BTN, LANGUAGES, QUALITY, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL
+from utils import TTLCache, SingleFlight
 
 client = AsyncIOMotorClient(DATABASE_URL)
 db = client[DATABASE_NAME]
 instance = Instance.from_db(db)
+logger = logging.getLogger(__name__)
 
-replacements = [
-    (r"\bAuds\b", "Audios"),
-    (r"\bAud\b", "Audio"),
-    (r"\bOrg\b", "Original"),
-    (r"\bTam\b", "Tamil"),
-    (r"\bTel\b", "Telugu"),
-    (r"\bHin\b", "Hindi"),
-    (r"\bEng\b", "English"),
-    (r"\bMal\b", "Malayalam"),
-    (r"\bKan\b", "Kannada"),
-    (r"\bKor\b", "Korean"),
-    (r"\bChi\b", "Chinese"),
-]
+replacements = {
+    "Auds": "Audios",
+    "Aud": "Audio",
+    "Org": "Original",
+    "Tam": "Tamil",
+    "Tel": "Telugu",
+    "Hin": "Hindi",
+    "Eng": "English",
+    "Mal": "Malayalam",
+    "Kan": "Kannada",
+    "Kor": "Korean",
+    "Chi": "Chinese",
+}
+# Every abbreviation is expanded in a single pass of one alternation regex
+replacement_pattern = re.compile(r"\b(?:" + "|".join(sorted(map(re.escape, replacements), key=len, reverse=True)) + r")\b")
+channel_prefix = re.compile(r"^@\w+ - ")
+
+# Anything that is not a letter or digit separates tokens, this covers the
+# usual `.`, `_`, `-`, `+` and whitespace separators as well as brackets.
+token_split = re.compile(r"[\W_]+")
+_last_indexed_at = 0
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+# Bumped when saved files need new search fields, update_search_index then backfills them once
+SEARCH_INDEX_VERSION = 1
+# The language and quality lists the facets of a file were built from
+FACETS_VERSION = hashlib.sha1(' '.join(LANGUAGES + ['|'] + [qual.lower() for qual in QUALITY]).encode()).hexdigest()[:12]
+# Until the backfill is done files with other facets are also matched the old way
+search_index_ready = False
+search_flight = SingleFlight()
 
 @instance.register
 class Media(Document):
@@ -36,107 +57,290 @@ class Media(Document):
     mime_type = fields.StrField(allow_none=True)
     caption = fields.StrField(allow_none=True)
     file_type = fields.StrField(allow_none=True)
+    tokens = fields.ListField(fields.StrField(), allow_none=True)
+    indexed_at = fields.IntField(allow_none=True)
+    languages = fields.ListField(fields.StrField(), allow_none=True)
+    qualities = fields.ListField(fields.StrField(), allow_none=True)
+    facets = fields.StrField(allow_none=True)
     
     class Meta:
-        indexes = ('$file_name', )
+        indexes = ('$file_name', ('tokens', '-indexed_at'), '-indexed_at', 'facets')
         collection_name = COLLECTION_NAME
 
-async def save_file(media):
-    """Save file in database"""
+def get_tokens(text):
+    """Return the unique lower-cased search tokens of a file name or query"""
+    return list(dict.fromkeys(token for token in token_split.split(str(text).lower()) if token))
+
+def next_indexed_at():
+    """Return a strictly increasing millisecond timestamp used as the sort key"""
+    global _last_indexed_at
+    _last_indexed_at = max(int(time.time() * 1000), _last_indexed_at + 1)
+    return _last_indexed_at
+
+def get_facets(file_name):
+    """Return the configured languages and qualities mentioned in a file name"""
+    name = str(file_name).lower()
+    languages = [lang for lang in LANGUAGES if lang in name]
+    qualities = [qual.lower() for qual in QUALITY if qual.lower() in name]
+    return languages, qualities
+
+def get_legacy_pattern(query):
+    """The file name regex searches used before files had tokens"""
+    query = str(query).strip()
+    if not query:
+        raw_pattern = '.'
+    elif ' ' not in query:
+        raw_pattern = r'(\b|[\.\+\-_])' + query + r'(\b|[\.\+\-_])'
+    else:
+        raw_pattern = query.replace(' ', r'.*[\s\.\+\-_]')
+    try:
+        return re.compile(raw_pattern, flags=re.IGNORECASE)
+    except re.error:
+        return re.compile(re.escape(query), flags=re.IGNORECASE)
+
+def get_search_filter(query, lang=None, quality=None):
+    tokens = get_tokens(query)
+    filter = {'tokens': {'$all': tokens}} if tokens else {}
+    if lang:
+        filter['languages'] = lang.lower()
+    if quality:
+        filter['qualities'] = quality.lower()
+    if search_index_ready or not filter:
+        return filter
+    # Files the backfill has not reached yet have no tokens or facets of other lists
+    legacy = [{'file_name': get_legacy_pattern(query)}] if tokens else []
+    for facet in (lang, quality):
+        if facet:
+            legacy.append({'file_name': re.compile(re.escape(facet), flags=re.IGNORECASE)})
+    return {'$or': [filter, {'facets': {'$ne': FACETS_VERSION}, '$and': legacy}]}
+
+def invalidate_search_cache(*file_names):
+    """Drop cached pages that may contain a file with one of these names, or every page"""
+    if not file_names:
+        search_cache.clear()
+        return
+    token_sets = [set(get_tokens(file_name)) for file_name in file_names]
+    for key in search_cache.keys():
+        if any(tokens.issuperset(key[0]) for tokens in token_sets):
+            search_cache.pop(key)
+
+def expand_abbreviations(text):
+    """Expand the language and audio abbreviations used in release names"""
+    return replacement_pattern.sub(lambda match: replacements[match.group(0)], text)
+
+def normalize_caption(caption):
+    """Return the file name and caption saved for a media caption"""
+    file_caption = expand_abbreviations(str(caption))
+    file_name = channel_prefix.sub("", file_caption)
+    return file_name, file_caption
+
+def get_media_file(media):
+    """Build the Media document of a message media, None if it does not validate"""
 
     # TODO: Find better way to get same file_id for same media to avoid duplicates
     file_id, file_ref = unpack_new_file_id(media.file_id)
-    file_name = re.sub(r"^@\w+ - ", "", str(media.caption))
-    file_caption = str(media.caption)
-    for pattern, replacement in replacements:
-        file_name = re.sub(pattern, replacement, file_name)
-        file_caption = re.sub(pattern, replacement, file_caption)
+    file_name, file_caption = normalize_caption(media.caption)
+    languages, qualities = get_facets(file_name)
     try:
-        file = Media(
+        return Media(
             file_id=file_id,
             file_ref=file_ref,
             file_name=file_name,
             file_size=media.file_size,
             mime_type=media.mime_type,
             caption=file_caption,
-            file_type=media.mime_type.split('/')[0]
+            file_type=media.mime_type.split('/')[0],
+            tokens=get_tokens(file_name),
+            indexed_at=next_indexed_at(),
+            languages=languages,
+            qualities=qualities,
+            facets=FACETS_VERSION
         )
     except ValidationError:
+        return None
+
+async def save_file(media):
+    """Save file in database"""
+    file = get_media_file(media)
+    if file is None:
         print('Error occurred while saving file in database')
         return 'err'
+    try:
+        await file.commit()
+    except DuplicateKeyError:      
+        print(f'{getattr(media, "file_name", "NO_FILE")} is already saved in database') 
+        return 'dup'
     else:
-        try:
-            await file.commit()
-        except DuplicateKeyError:      
-            print(f'{getattr(media, "file_name", "NO_FILE")} is already saved in database') 
-            return 'dup'
-        else:
-            print(f'{getattr(media, "file_name", "NO_FILE")} is saved to database')
-            return 'suc'
+        invalidate_search_cache(file.file_name)
+        print(f'{getattr(media, "file_name", "NO_FILE")} is saved to database')
+        return 'suc'
 
-async def get_search_results(query, max_results=MAX_BTN, offset=0, lang=None):
-    query = str(query) # to ensure the query is string to stripe.
-    query = query.strip()
-    if not query:
-        raw_pattern = '.'
-    elif ' ' not in query:
-        raw_pattern = r'(\b|[\.\+\-_])' + query + r'(\b|[\.\+\-_])'
-    else:
-        raw_pattern = query.replace(' ', r'.*[\s\.\+\-_]') 
+async def save_files(medias):
+    """Save many files with one unordered insert_many
+
+    Returns the number of saved files, of duplicates rejected by the unique
+    _id and of files that failed validation or could not be written.
+    """
+    files = []
+    errors = 0
+    for media in medias:
+        file = get_media_file(media)
+        if file is None:
+            errors += 1
+        else:
+            files.append(file)
+    if not files:
+        return 0, 0, errors
     try:
-        regex = re.compile(raw_pattern, flags=re.IGNORECASE)
-    except:
-        regex = query
+        result = await Media.collection.insert_many([file.to_mongo() for file in files], ordered=False)
+    except BulkWriteError as e:
+        write_errors = e.details.get('writeErrors', [])
+        duplicate = sum(1 for error in write_errors if error.get('code') == 11000)
+        errors += len(write_errors) - duplicate
+        saved = e.details.get('nInserted', 0)
+    else:
+        duplicate = 0
+        saved = len(result.inserted_ids)
+    if saved:
+        invalidate_search_cache(*(file.file_name for file in files))
+    return saved, duplicate, errors
 
-    filter = {'file_name': regex}
-    cursor = Media.find(filter)
+async def search_page(filter, offset, max_results, after=None, before=None, total_results=None):
+    """Return one page of matching files and the total count
 
-    # Sort by recent
-    cursor.sort('$natural', -1)
+    Pages are addressed either by offset or by keyset: `after` returns the
+    files older than that indexed_at value and `before` the newer ones, so
+    deep pages skip nothing and stay put while new files are indexed. The
+    keyset bound is part of the query, the (tokens, -indexed_at) index then
+    stops the walk at the page, and the total found for the first page is
+    passed in instead of being counted again.
+    """
+    if after is not None or before is not None:
+        bound = {'$lt': after} if after is not None else {'$gt': before}
+        cursor = Media.collection.find({**filter, 'indexed_at': bound}).sort('indexed_at', -1 if after is not None else 1)
+        files = [Media.build_from_mongo(file) async for file in cursor.limit(max_results)]
+        if before is not None:
+            files.reverse()
+        if total_results is None:
+            total_results = await count_files(filter)
+        return files, total_results
+    if not filter:
+        # Nothing to match, as for an empty query: the -indexed_at index
+        # serves the sort and the total comes from the collection metadata.
+        cursor = Media.collection.find().sort('indexed_at', -1).skip(offset).limit(max_results)
+        files = [Media.build_from_mongo(file) async for file in cursor]
+        return files, await count_files(filter)
+    # The page and the total in a single round trip
+    pipeline = [
+        {'$match': filter},
+        {'$sort': {'indexed_at': -1}},
+        {'$facet': {
+            'files': [{'$skip': offset}, {'$limit': max_results}],
+            'total': [{'$count': 'total'}]
+        }}
+    ]
+    result = await Media.collection.aggregate(pipeline).to_list(length=1)
+    if not result:
+        return [], 0
+    files = [Media.build_from_mongo(file) for file in result[0]['files']]
+    total_results = result[0]['total'][0]['total'] if result[0]['total'] else 0
+    return files, total_results
 
-    if lang:
-        lang_files = [file async for file in cursor if lang in file.file_name.lower()]
-        files = lang_files[offset:][:max_results]
-        total_results = len(lang_files)
-        next_offset = offset + max_results
-        if next_offset >= total_results:
-            next_offset = ''
-        return files, next_offset, total_results
-        
-    # Slice files according to offset and max results
-    cursor.skip(offset).limit(max_results)
-    # Get list of files
-    files = await cursor.to_list(length=max_results)
-    total_results = await Media.count_documents(filter)
+async def count_files(filter):
+    if not filter:
+        return await Media.collection.estimated_document_count()
+    return await Media.collection.count_documents(filter)
+
+async def get_search_results(query, max_results=MAX_BTN, offset=0, lang=None, quality=None, after=None, before=None):
+    """Search files, `offset` only numbers the page when a keyset cursor is given"""
+    tokens = get_tokens(query)
+    key = (tuple(tokens), offset, max_results, lang, quality, after, before)
+
+    async def search():
+        filter = get_search_filter(query, lang, quality)
+        total_results = None
+        if after is not None or before is not None:
+            # Keyset pages reuse the total of the first page while it is cached
+            first_page = search_cache.get((tuple(tokens), 0, max_results, lang, quality, None, None), count=False)
+            if first_page:
+                total_results = first_page[1]
+        result = await search_page(filter, offset, max_results, after, before, total_results)
+        search_cache.set(key, result)
+        return result
+
+    cached = search_cache.get(key)
+    if cached:
+        files, total_results = cached
+    else:
+        # Users searching the same title at once share one query
+        files, total_results = await search_flight.do(key, search)
     next_offset = offset + max_results
     if next_offset >= total_results:
         next_offset = ''       
     return files, next_offset, total_results
     
 async def delete_files(query):
-    query = query.strip()
-    if not query:
-        raw_pattern = '.'
-    elif ' ' not in query:
-        raw_pattern = r'(\b|[\.\+\-_])' + query + r'(\b|[\.\+\-_])'
-    else:
-        raw_pattern = query.replace(' ', r'.*[\s\.\+\-_]')
-    
-    try:
-        regex = re.compile(raw_pattern, flags=re.IGNORECASE)
-    except:
-        regex = query
-    filter = {'file_name': regex}
+    filter = get_search_filter(query)
     total = await Media.count_documents(filter)
     files = Media.find(filter)
     return total, files
 
+async def update_search_index(batch_size=1000):
+    """Add search tokens and facets to files saved before they existed
+
+    Facets are also rebuilt for files saved under other LANGUAGES or QUALITY
+    lists. The finished backfill is recorded with SEARCH_INDEX_VERSION and
+    FACETS_VERSION, later boots with the same ones skip the scan.
+    """
+    global search_index_ready
+    state = await db.search_index.find_one({'_id': COLLECTION_NAME}) or {}
+    if state.get('version') != SEARCH_INDEX_VERSION:
+        stale = {}
+    elif state.get('facets') != FACETS_VERSION:
+        stale = {'facets': {'$ne': FACETS_VERSION}}
+    else:
+        search_index_ready = True
+        return 0
+    # Old files keep their insertion order by getting small sort keys that
+    # always rank below the millisecond timestamps of newly saved files.
+    position = await Media.collection.count_documents({'indexed_at': {'$lt': 10 ** 12}})
+    cursor = Media.collection.find(stale, {'file_name': 1, 'indexed_at': 1}).sort('$natural', 1)
+    updated = 0
+    requests = []
+    async for file in cursor:
+        file_name = file.get('file_name', '')
+        languages, qualities = get_facets(file_name)
+        fields = {'tokens': get_tokens(file_name), 'languages': languages, 'qualities': qualities, 'facets': FACETS_VERSION}
+        if file.get('indexed_at') is None:
+            position += 1
+            fields['indexed_at'] = position
+        requests.append(UpdateOne({'_id': file['_id']}, {'$set': fields}))
+        if len(requests) >= batch_size:
+            await Media.collection.bulk_write(requests, ordered=False)
+            updated += len(requests)
+            requests = []
+    if requests:
+        await Media.collection.bulk_write(requests, ordered=False)
+        updated += len(requests)
+    await db.search_index.update_one({'_id': COLLECTION_NAME}, {'$set': {'version': SEARCH_INDEX_VERSION, 'facets': FACETS_VERSION}}, upsert=True)
+    search_index_ready = True
+    # Pages cached during the backfill were found with the old matching
+    invalidate_search_cache()
+    if updated:
+        logger.info(f"Updated search index of {updated} files")
+    return updated
+
 async def get_file_details(query):
     filter = {'file_id': query}
     cursor = Media.find(filter)
     filedetails = await cursor.to_list(length=1)
     return filedetails
 
+async def get_files(file_ids):
+    """Media documents of file ids, in the order of the ids"""
+    files = {file.file_id: file async for file in Media.find({'file_id': {'$in': file_ids}})}
+    return [files[file_id] for file_id in file_ids if file_id in files]
+
 def encode_file_id(s: bytes) -> str:
     r = b""
     n = 0
@@ -1,4 +1,5 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 from info import DATABASE_NAME, DATABASE_URL, IMDB_TEMPLATE, WELCOME_TEXT, LINK_MODE, TUTORIAL, SHORTLINK_URL, SHORTLINK_API, SHORTLINK, FILE_CAPTION, IMDB, WELCOME, SPELL_CHECK, PROTECT_CONTENT, AUTO_FILTER, AUTO_DELETE, IS_STREAM, VERIFY_EXPIRE, IS_PM_SEARCH, IS_SEND_MOVIE_UPDATE, FORCE_SUB
 import time
 import datetime
@@ -46,6 +47,11 @@ class Database:
         self.tb = mydb.TamilBlaster_List
         self.tr = mydb.TamilRockers_List
         self.domains = mydb.Domains
+        self.index_jobs = mydb.index_jobs
+        self.stream_workers = mydb.stream_workers
+        self.imdb = mydb.imdb
+        self.search_sessions = mydb.search_sessions
+        self.shortlinks = mydb.shortlinks
     
     def new_user(self, id, name):
         return dict(
@@ -137,13 +143,29 @@ class Database:
         await self.grp.update_one({'id': int(id)}, {'$set': {'chat_status': chat_status}})
         
     async def update_settings(self, id, settings):
-        await self.grp.update_one({'id': int(id)}, {'$set': {'settings': settings}})      
+        # updated_at is the version other bot processes poll for changes
+        await self.grp.update_one({'id': int(id)}, {'$set': {'settings': settings, 'updated_at': datetime.datetime.now()}})      
     
     async def get_settings(self, id):
         chat = await self.grp.find_one({'id':int(id)})
         if chat:
-            return chat.get('settings', self.default_setgs)
-        return self.default_setgs
+            return chat.get('settings', dict(self.default_setgs))
+        return dict(self.default_setgs)
+
+    def watch_settings(self):
+        pipeline = [{'$match': {'$or': [
+            {'operationType': {'$in': ['replace', 'delete']}},
+            {'updateDescription.updatedFields.settings': {'$exists': True}}
+        ]}}]
+        return self.grp.watch(pipeline, full_document='updateLookup')
+
+    async def get_settings_version(self):
+        await self.grp.create_index('updated_at')
+        chat = await self.grp.find_one({'updated_at': {'$exists': True}}, sort=[('updated_at', -1)])
+        return chat['updated_at'] if chat else datetime.datetime.min
+
+    def get_changed_settings(self, since):
+        return self.grp.find({'updated_at': {'$gt': since}}, {'id': 1, 'updated_at': 1})
     
     async def disable_chat(self, chat, reason="No Reason"):
         chat_status=dict(
@@ -346,6 +368,108 @@ class Database:
         user = await self.tr.find_one({'magnet_url': url})
         return True if user else False
 
+    # Indexing Job Functions
+    async def add_index_job(self, chat, last_msg_id, skip, status_chat_id, status_msg_id):
+        job = dict(
+            chat=chat,
+            last_msg_id=last_msg_id,
+            current=skip,
+            state='queued',
+            stats={},
+            status_chat_id=status_chat_id,
+            status_msg_id=status_msg_id,
+            created_at=datetime.datetime.now()
+        )
+        await self.index_jobs.insert_one(job)
+        return job
+
+    async def claim_index_job(self, owner, lease):
+        """
+        Take the next job for owner until lease seconds from now, as the job was before.
+        An interrupted job whose lease ran out, or that was owner's own, comes first,
+        otherwise the oldest queued job. Other bot processes never get the same job.
+        """
+        now = datetime.datetime.now()
+        update = {'$set': {'state': 'running', 'owner': owner, 'lease_until': now + datetime.timedelta(seconds=lease)}}
+        resumable = {
+            'state': 'running',
+            '$or': [{'owner': owner}, {'lease_until': {'$lt': now}}, {'lease_until': {'$exists': False}}]
+        }
+        for filter in (resumable, {'state': 'queued'}):
+            job = await self.index_jobs.find_one_and_update(
+                filter, update, sort=[('created_at', 1)], return_document=ReturnDocument.BEFORE
+            )
+            if job:
+                return job
+        return None
+
+    async def renew_index_job(self, job_id, owner, lease):
+        """Extend the lease of a job, False when owner no longer holds it"""
+        lease_until = datetime.datetime.now() + datetime.timedelta(seconds=lease)
+        result = await self.index_jobs.update_one({'_id': job_id, 'owner': owner}, {'$set': {'lease_until': lease_until}})
+        return result.matched_count == 1
+
+    async def update_index_job(self, job_id, current=None, owner=None, **fields):
+        update = {}
+        if fields:
+            update['$set'] = fields
+        if current is not None:
+            # Checkpoints may land out of order, never move the position back
+            update['$max'] = {'current': current}
+        filter = {'_id': job_id}
+        if owner is not None:
+            # A process that lost the job to another one leaves it alone
+            filter['owner'] = owner
+        await self.index_jobs.update_one(filter, update)
+
+    async def count_index_jobs(self):
+        return await self.index_jobs.count_documents({'state': {'$in': ['queued', 'running']}})
+
+    # IMDb Cache Functions
+    async def create_imdb_index(self, ttl):
+        # Mongo drops cached lookups by itself once they are older than ttl
+        await self.imdb.create_index('updated_at', expireAfterSeconds=ttl)
+
+    async def get_imdb(self, key):
+        doc = await self.imdb.find_one({'_id': key})
+        return doc['data'] if doc else None
+
+    async def set_imdb(self, key, data):
+        await self.imdb.update_one({'_id': key}, {'$set': {'data': data, 'updated_at': datetime.datetime.now()}}, upsert=True)
+
+    # Search Session Functions
+    async def create_search_session_index(self, ttl):
+        await self.search_sessions.create_index('updated_at', expireAfterSeconds=ttl)
+
+    async def get_search_session(self, key):
+        session = await self.search_sessions.find_one({'_id': key}, {'_id': 0, 'updated_at': 0})
+        return session or {}
+
+    async def update_search_session(self, key, fields):
+        await self.search_sessions.update_one({'_id': key}, {'$set': dict(fields, updated_at=datetime.datetime.now())}, upsert=True)
+
+    # Shortlink Cache Functions
+    async def create_shortlink_index(self, ttl):
+        await self.shortlinks.create_index('updated_at', expireAfterSeconds=ttl)
+        # Entries from before the keys held an API key digest carry the key itself
+        await self.shortlinks.delete_many({'_id': {'$not': {'$regex': r'^[^|]*\|[0-9a-f]{16}\|'}}})
+
+    async def get_shortlink(self, key):
+        doc = await self.shortlinks.find_one({'_id': key})
+        return doc['link'] if doc else None
+
+    async def set_shortlink(self, key, link):
+        await self.shortlinks.update_one({'_id': key}, {'$set': {'link': link, 'updated_at': datetime.datetime.now()}}, upsert=True)
+
+    # Stream Worker Functions
+    async def update_stream_worker(self, worker, **fields):
+        fields['last_seen'] = datetime.datetime.now()
+        await self.stream_workers.update_one({'_id': worker}, {'$set': fields}, upsert=True)
+
+    async def get_stream_workers(self, timeout=30):
+        since = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+        return await self.stream_workers.find({'last_seen': {'$gt': since}}).sort('_id', 1).to_list(None)
+
     # Domain Management Functions
     async def update_domain(self, key, url):
         """
@@ -1,6 +1,7 @@
 import re
 import logging
 from os import environ, path
+from ipaddress import ip_network
 from Script import script
 
 # Load environment variables from .env file if it exists
@@ -197,6 +198,20 @@ logger.info('🔗 Links configured successfully')
 DELETE_TIME = int(environ.get('DELETE_TIME', 3600))
 CACHE_TIME = int(environ.get('CACHE_TIME', 300))
 MAX_BTN = int(environ.get('MAX_BTN', 10))
+SEARCH_CACHE_SIZE = int(environ.get('SEARCH_CACHE_SIZE', 1024))
+SEARCH_CACHE_TTL = int(environ.get('SEARCH_CACHE_TTL', 300))
+# Result messages whose search, caption and file ids are kept for their buttons
+SEARCH_SESSION_SIZE = int(environ.get('SEARCH_SESSION_SIZE', 2048))
+SEARCH_SESSION_TTL = int(environ.get('SEARCH_SESSION_TTL', 86400))
+SETTINGS_CACHE_SIZE = int(environ.get('SETTINGS_CACHE_SIZE', 1024))
+SETTINGS_CACHE_TTL = int(environ.get('SETTINGS_CACHE_TTL', 600))
+SETTINGS_POLL_INTERVAL = int(environ.get('SETTINGS_POLL_INTERVAL', 30))
+# IMDb lookups kept in memory and in the database, the TTL is in seconds
+IMDB_CACHE_SIZE = int(environ.get('IMDB_CACHE_SIZE', 512))
+IMDB_CACHE_TTL = int(environ.get('IMDB_CACHE_TTL', 7 * 24 * 3600))
+# Threads running IMDb requests and how long a reply waits for one, in seconds
+IMDB_WORKERS = int(environ.get('IMDB_WORKERS', 4))
+IMDB_TIMEOUT = int(environ.get('IMDB_TIMEOUT', 15))
 
 LANGUAGES = environ.get('LANGUAGES', 'tamil hindi english telugu kannada malayalam marathi punjabi')
 LANGUAGES = [lang.lower().strip() for lang in LANGUAGES.split() if lang.strip()]
@@ -218,6 +233,10 @@ INDEX_EXTENSIONS = [ext.lower().strip() for ext in INDEX_EXTENSIONS.split() if e
 logger.info(f'📄 Index extensions: {", ".join(INDEX_EXTENSIONS)}')
 
 PM_FILE_DELETE_TIME = int(environ.get('PM_FILE_DELETE_TIME', '3600'))
+INDEX_BATCH_SIZE = int(environ.get('INDEX_BATCH_SIZE', 200))
+INDEX_WORKERS = int(environ.get('INDEX_WORKERS', 4))
+INDEX_QUEUE_SIZE = int(environ.get('INDEX_QUEUE_SIZE', 8))
+INDEX_PROGRESS_INTERVAL = int(environ.get('INDEX_PROGRESS_INTERVAL', 20))
 
 # ============================================
 # 🔘 BOOLEAN SETTINGS
@@ -229,12 +248,18 @@ IS_SEND_MOVIE_UPDATE = is_enabled('IS_SEND_MOVIE_UPDATE', True)
 AUTO_DELETE = is_enabled('AUTO_DELETE', True)
 WELCOME = is_enabled('WELCOME', False)
 PROTECT_CONTENT = is_enabled('PROTECT_CONTENT', False)
+# Keep search sessions in the database too, so buttons keep working after a restart
+SEARCH_SESSION_DB = is_enabled('SEARCH_SESSION_DB', True)
 LONG_IMDB_DESCRIPTION = is_enabled("LONG_IMDB_DESCRIPTION", False)
 LINK_MODE = is_enabled("LINK_MODE", True)
 AUTO_FILTER = is_enabled('AUTO_FILTER', True)
 IMDB = is_enabled('IMDB', True)
 SPELL_CHECK = is_enabled("SPELL_CHECK", True)
 SHORTLINK = is_enabled('SHORTLINK', False)
+# Shortened links are reused for this many seconds, a shortener slower than the timeout gets the direct link
+SHORTLINK_CACHE_SIZE = int(environ.get('SHORTLINK_CACHE_SIZE', 4096))
+SHORTLINK_CACHE_TTL = int(environ.get('SHORTLINK_CACHE_TTL', 30 * 24 * 3600))
+SHORTLINK_TIMEOUT = int(environ.get('SHORTLINK_TIMEOUT', 10))
 IS_STREAM = is_enabled('IS_STREAM', True)
 
 logger.info('✅ Boolean settings loaded')
@@ -307,6 +332,36 @@ else:
     else:
         logger.error(f'❌ Invalid URL: {URL}')
 
+# Number of GetFile requests kept in flight ahead of a streaming client
+STREAM_PREFETCH = int(environ.get('STREAM_PREFETCH', 4))
+# Media sessions opened per DC and how often idle ones are pinged
+STREAM_SESSIONS = int(environ.get('STREAM_SESSIONS', 4))
+STREAM_SESSION_CHECK = int(environ.get('STREAM_SESSION_CHECK', 60))
+# Disk budget in MB for chunks of streamed files, 0 disables the cache
+STREAM_CACHE_DIR = environ.get('STREAM_CACHE_DIR', 'stream_cache')
+STREAM_CACHE_SIZE = int(environ.get('STREAM_CACHE_SIZE', 0))
+# BIN_CHANNEL files whose decoded properties are kept between range requests
+STREAM_FILES_CACHE_SIZE = int(environ.get('STREAM_FILES_CACHE_SIZE', 1024))
+STREAM_FILES_CACHE_TTL = int(environ.get('STREAM_FILES_CACHE_TTL', 600))
+# Concurrent streams overall and per client, rates in KB/s where 0 means unlimited
+STREAM_LIMIT = int(environ.get('STREAM_LIMIT', 64))
+STREAM_LIMIT_PER_IP = int(environ.get('STREAM_LIMIT_PER_IP', 4))
+STREAM_RATE = int(environ.get('STREAM_RATE', 0))
+STREAM_RATE_PER_IP = int(environ.get('STREAM_RATE_PER_IP', 0))
+# Bearer token for /metrics, without one it only answers requests from this machine
+METRICS_TOKEN = environ.get('METRICS_TOKEN', '')
+# Reverse proxies whose X-Forwarded-For names the client, space separated addresses or networks
+try:
+    TRUSTED_PROXY = [ip_network(proxy, strict=False) for proxy in environ.get('TRUSTED_PROXY', '').split()]
+except ValueError as e:
+    logger.error(f'❌ Invalid TRUSTED_PROXY: {e}')
+    TRUSTED_PROXY = []
+# Serve streams from this many separate processes instead of the bot's event loop, 0 keeps it in process
+STREAM_WORKERS = int(environ.get('STREAM_WORKERS', 0))
+# Set by bot.py for each worker process it starts
+STREAM_WORKER = environ.get('STREAM_WORKER')
+STREAM_SESSION = environ.get('STREAM_SESSION', '')
+
 # ============================================
 # 📊 CONFIGURATION SUMMARY
 # ============================================
@@ -1,13 +1,17 @@
 from pyrogram import Client, filters
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from info import INDEX_CHANNELS, LOG_CHANNEL, MOVIE_UPDATE_CHANNEL
-from database.ia_filterdb import save_file, unpack_new_file_id
+from database.ia_filterdb import save_file, unpack_new_file_id, expand_abbreviations
 from utils import get_poster, temp
 import re
 from database.users_chats_db import db
 
 processed_movies = set()
 media_filter = filters.document | filters.video
+# Compiled once, movie_name_format runs for every indexed file
+mention_pattern = re.compile(r'@\w+|#\w+')
+link_pattern = re.compile(r'http\S+')
+name_table = str.maketrans({'_': ' ', '.': ' ', **dict.fromkeys("[](){}@:;'-!")})
 
 @Client.on_message(filters.chat(INDEX_CHANNELS) & media_filter)
 async def media(bot, message):
@@ -19,7 +23,8 @@ async def media(bot, message):
         success_sts = await save_file(media)
         if success_sts == 'suc' and await db.get_send_movie_update_status(bot_id):
             file_id, file_ref = unpack_new_file_id(media.file_id)
-            await send_movie_updates(bot, file_name=media.file_name, caption=media.caption, file_id=file_id)
+            caption = expand_abbreviations(media.caption) if media.caption else media.caption
+            await send_movie_updates(bot, file_name=media.file_name, caption=caption, file_id=file_id)
 
 async def get_imdb(file_name):
     imdb_file_name = await movie_name_format(file_name)
@@ -29,18 +34,20 @@ async def get_imdb(file_name):
     return "https://telegra.ph/file/88d845b4f8a024a71465d.jpg"  # Default poster
 
 async def movie_name_format(file_name):
-  filename = re.sub(r'http\S+', '', re.sub(r'@\w+|#\w+', '', file_name).replace('_', ' ').replace('[', '').replace(']', '').replace('(', '').replace(')', '').replace('{', '').replace('}', '').replace('.', ' ').replace('@', '').replace(':', '').replace(';', '').replace("'", '').replace('-', '').replace('!', '')).strip()
+  filename = link_pattern.sub('', mention_pattern.sub('', file_name).translate(name_table)).strip()
   return filename
 
 async def check_qualities(text, qualities):
-    quality = [q for q in qualities if q.lower() in text.lower()]
+    text = text.lower()
+    quality = [q for q in qualities if q.lower() in text]
     return ", ".join(quality)
 
 async def check_languages(text, languages):
+    text = text.lower()
     matched_languages = []
     for lang, abbreviations in languages.items():
         for abbr in abbreviations:
-            if abbr.lower() in text.lower():
+            if abbr.lower() in text:
                 matched_languages.append(lang)
                 break  # Avoid duplicate detection
     return " + ".join(matched_languages)
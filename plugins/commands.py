@@ -1,4 +1,5 @@
 import os
+import re
 from telegraph import upload_file
 import random
 import string
@@ -8,7 +9,7 @@ import datetime
 from Script import script
 from pyrogram import Client, filters, enums
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message
-from database.ia_filterdb import Media, get_file_details, delete_files
+from database.ia_filterdb import Media, get_file_details, get_files, delete_files, unpack_new_file_id, invalidate_search_cache, search_cache
 from database.users_chats_db import db
 from info import INDEX_CHANNELS, MOVIE_UPDATE_CHANNEL, ADMINS, IS_VERIFY, VERIFY_TUTORIAL, VERIFY_EXPIRE, SHORTLINK_API, SHORTLINK_URL, DELETE_TIME, SUPPORT_LINK, UPDATES_LINK, LOG_CHANNEL, PICS, IS_STREAM, PAYMENT_QR, OWNER_USERNAME, PM_FILE_DELETE_TIME, OWNER_UPI_ID
 from utils import get_settings, get_size, is_subscribed, is_check_admin, get_shortlink, get_verify_status, update_verify_status, save_group_settings, temp, get_readable_time, get_wish, get_seconds
@@ -109,7 +110,12 @@ async def start(client, message):
         if IS_VERIFY and not verify_status['is_verified']:
             token = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
             await update_verify_status(message.from_user.id, verify_token=token, link="" if mc == 'inline_verify' else mc)
-            link = await get_shortlink(SHORTLINK_URL, SHORTLINK_API, f'https://t.me/{temp.U_NAME}?start=verify_{token}')
+            try:
+                # The direct link would skip the verification
+                link = await get_shortlink(SHORTLINK_URL, SHORTLINK_API, f'https://t.me/{temp.U_NAME}?start=verify_{token}', fallback=False, cache=False)
+            except Exception as e:
+                print(f"Failed to shorten the verify link: {e}")
+                return await message.reply("❌ Verification is unavailable right now, please try again later.", protect_content=True)
             btn = [[
                 InlineKeyboardButton("🧿 Verify 🧿", url=link)
             ],[
@@ -138,7 +144,7 @@ async def start(client, message):
         
     if mc.startswith('all'):
         _, grp_id, key = mc.split("_", 2)
-        files = temp.FILES.get(key)
+        files = await get_files((await temp.SEARCHES.get(key)).get('files') or [])
         if not files:
             return await message.reply('No Such All Files Exist!')
         settings = await get_settings(int(grp_id))
@@ -274,7 +280,7 @@ async def stats(bot, message):
     u_size_int = await db.get_db_size()
     f_size = get_size(536870912 - u_size_int)
     uptime = get_readable_time(time_now() - temp.START_TIME)
-    await message.reply_text(script.STATUS_TXT.format(files, users, chats, premium, u_size, f_size, uptime))    
+    await message.reply_text(script.STATUS_TXT.format(files, users, chats, premium, u_size, f_size, search_cache.hits, search_cache.misses, uptime))    
     
 @Client.on_message(filters.command('settings'))
 async def settings(client, message):
@@ -379,7 +385,7 @@ async def save_shortlink(client, message):
     except:
         return await message.reply_text("<b>Command Incomplete:-\n\ngive me a shortlink & api along with the command...\n\nEx:- <code>/shortlink mdisklink.link 5843c3cc645f5077b2200a2c77e0344879880b3e</code>")   
     try:
-        await get_shortlink(url, api, f'https://t.me/{temp.U_NAME}')
+        await get_shortlink(url, api, f'https://t.me/{temp.U_NAME}', fallback=False)
     except:
         return await message.reply_text("Your shortlink API or URL invalid, Please Check again!")   
     await save_group_settings(grp_id, 'url', url)
@@ -449,6 +455,7 @@ async def delete(bot, message):
     else: return await msg.edit('This Is Not Supported File Format')
     file_id, file_ref = unpack_new_file_id(media.file_id)
     result = await Media.collection.delete_one({'_id': file_id})
+    invalidate_search_cache()
     if result.deleted_count: await msg.edit('File Is Successfully Deleted From Database')
     else:
         file_name = re.sub(r"(_|\-|\.|\+)", " ", str(media.file_name))
@@ -457,6 +464,7 @@ async def delete(bot, message):
             'file_size': media.file_size,
             'mime_type': media.mime_type
             })
+        invalidate_search_cache()
         if result.deleted_count: await msg.edit('File Is Successfully Deleted From Database')
         else:
             result = await Media.collection.delete_many({
@@ -464,6 +472,7 @@ async def delete(bot, message):
                 'file_size': media.file_size,
                 'mime_type': media.mime_type
             })
+            invalidate_search_cache()
             if result.deleted_count: await msg.edit('File Is Successfully Deleted From Database')
             else: await msg.edit('File Not Found In Database')
 
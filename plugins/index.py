@@ -1,15 +1,24 @@
-import logging, re, asyncio
+import logging, re, asyncio, os, socket
+from collections import deque
 from pyrogram import Client, filters, enums
-from pyrogram.errors import FloodWait
+from pyrogram.errors import FloodWait, MessageNotModified
 from pyrogram.errors.exceptions.bad_request_400 import ChannelInvalid, ChatAdminRequired, UsernameInvalid, UsernameNotModified
-from info import LOG_CHANNEL, ADMINS, INDEX_EXTENSIONS
-from database.ia_filterdb import save_file
-from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from info import LOG_CHANNEL, ADMINS, INDEX_EXTENSIONS, INDEX_BATCH_SIZE, INDEX_WORKERS, INDEX_QUEUE_SIZE, INDEX_PROGRESS_INTERVAL
+from database.ia_filterdb import save_files
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from database.users_chats_db import db
 from utils import temp
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-lock = asyncio.Lock()
+jobs_added = asyncio.Event()
+runner = None
+# Telegram returns at most 200 messages per get_messages call
+FETCH_WINDOW = min(INDEX_BATCH_SIZE, 200)
+# Bot processes sharing the database claim jobs for this long and renew the claim while indexing,
+# the pid stays the same over a /restart so a restarted bot resumes its own job right away
+JOB_OWNER = f'{socket.gethostname()}:{os.getpid()}'
+JOB_LEASE = 60
 
 @Client.on_message((filters.forwarded | (filters.regex("(https://)?(t\.me/|telegram\.me/|telegram\.dog/)(c/)?(\d+|[a-zA-Z_0-9]+)/(\d+)$")) & filters.text) & filters.private & filters.incoming & filters.user(ADMINS))
 async def send_for_index(bot, message):
@@ -45,9 +54,11 @@ async def send_for_index(bot, message):
     if k.empty:
         return await message.reply("❌ This may be a group, and I am not an admin of the group.")
     
-    # Start indexing directly
-    msg = await message.reply("✅ Indexing Starting..!")
-    await index_files_to_db(last_msg_id, chat_id, msg, bot)
+    queued = await db.count_index_jobs()
+    msg = await message.reply(f"✅ Indexing Queued! ({queued} job(s) ahead)" if queued else "✅ Indexing Starting..!")
+    await db.add_index_job(chat_id, last_msg_id, temp.CURRENT, msg.chat.id, msg.id)
+    jobs_added.set()
+    start_index_jobs(bot)
 
 @Client.on_message(filters.command('setskip') & filters.user(ADMINS))
 async def set_skip_number(bot, message):
@@ -62,70 +73,190 @@ async def set_skip_number(bot, message):
     else:
         await message.reply("❌ Provide a valid skip number.")
         
-async def index_files_to_db(lst_msg_id, chat, msg, bot):
-    total_files = 0
-    duplicate = 0
-    errors = 0
-    deleted = 0
-    no_media = 0
-    unsupported = 0
-    async with lock:
+@Client.on_callback_query(filters.regex(r"^index_cancel") & filters.user(ADMINS))
+async def cancel_index(bot, query: CallbackQuery):
+    temp.CANCEL = True
+    await query.answer("Cancelling Indexing...")
+
+def index_status(stats):
+    return (
+        f"Total Messages Fetched: <code>{stats['fetched']}</code>\n"
+        f"Total Messages Saved: <code>{stats['saved']}</code>\n"
+        f"Duplicate Files Skipped: <code>{stats['duplicate']}</code>\n"
+        f"Deleted Messages Skipped: <code>{stats['deleted']}</code>\n"
+        f"Non-Media Messages Skipped: <code>{stats['no_media'] + stats['unsupported']}</code>(Unsupported Media - `{stats['unsupported']}` )\n"
+        f"Errors Occurred: <code>{stats['errors']}</code>"
+    )
+
+async def fetch_messages(bot, job, queue, stats, pending):
+    """Fetch the channel messages from `current` up to `last_msg_id` into the queue until done or cancelled
+
+    Each get_messages window of message ids is queued as one batch.
+    """
+    current = job['current']
+    last = job['last_msg_id']
+    while current <= last and not temp.CANCEL:
+        end = min(current + FETCH_WINDOW, last + 1)
+        try:
+            messages = await bot.get_messages(job['chat'], list(range(current, end)))
+        except FloodWait as t:
+            await asyncio.sleep(t.value)
+            continue
+        stats['fetched'] = current = end
+        pending.append(current)
+        await queue.put((current, messages))
+
+def get_index_media(message, stats):
+    if message.empty:
+        stats['deleted'] += 1
+        return None
+    elif not message.media:
+        stats['no_media'] += 1
+        return None
+    elif message.media not in [enums.MessageMediaType.VIDEO, enums.MessageMediaType.DOCUMENT]:
+        stats['unsupported'] += 1
+        return None
+    media = getattr(message, message.media.value, None)
+    if not media or not (str(media.file_name).lower()).endswith(tuple(INDEX_EXTENSIONS)):
+        stats['unsupported'] += 1
+        return None
+    media.file_type = message.media.value
+    media.caption = message.caption
+    return media
+
+async def write_files(job, queue, stats, checkpoint_stats, pending, done):
+    """Normalize queued message batches and write their files until a None arrives
+
+    Batches finish out of order, so the checkpoint only advances to the end
+    of the longest run of finished batches in fetch order, and the counters
+    saved with it only include those batches.
+    """
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        end, batch = item
+        counts = dict.fromkeys(('saved', 'duplicate', 'errors', 'deleted', 'no_media', 'unsupported'), 0)
+        medias = [media for media in (get_index_media(message, counts) for message in batch) if media]
         try:
-            current = temp.CURRENT
-            temp.CANCEL = False
-            async for message in bot.iter_messages(chat, lst_msg_id, current):
-                if temp.CANCEL:
-                    await msg.edit(f"Successfully Cancelled!!\n\nSaved <code>{total_files}</code> files to database!\nDuplicate Files Skipped: <code>{duplicate}</code>\nDeleted Messages Skipped: <code>{deleted}</code>\nNon-Media messages skipped: <code>{no_media + unsupported}</code>(Unsupported Media - `{unsupported}` )\nErrors Occurred: <code>{errors}</code>")
-                    break
-                current += 1
-                if current % 100 == 0:
-                    can = [[InlineKeyboardButton('Cancel', callback_data='index_cancel')]]
-                    reply = InlineKeyboardMarkup(can)
-                    try:
-                        await msg.edit_text(
-                            text=f"Total Messages Fetched: <code>{current}</code>\nTotal Messages Saved: <code>{total_files}</code>\nDuplicate Files Skipped: <code>{duplicate}</code>\nDeleted Messages Skipped: <code>{deleted}</code>\nNon-Media messages skipped: <code>{no_media + unsupported}</code>(Unsupported Media - `{unsupported}` )\nErrors Occurred: <code>{errors}</code>",
-                            reply_markup=reply
-                        )       
-                    except FloodWait as t:
-                        await asyncio.sleep(t.value)
-                        await msg.edit_text(
-                            text=f"Total Messages Fetched: <code>{current}</code>\nTotal Messages Saved: <code>{total_files}</code>\nDuplicate Files Skipped: <code>{duplicate}</code>\nDeleted Messages Skipped: <code>{deleted}</code>\nNon-Media messages skipped: <code>{no_media + unsupported}</code>(Unsupported Media - `{unsupported}` )\nErrors Occurred: <code>{errors}</code>",
-                            reply_markup=reply
-                        )                          
-                if message.empty:
-                    deleted += 1
-                    continue
-                elif not message.media:
-                    no_media += 1
-                    continue
-                elif message.media not in [enums.MessageMediaType.VIDEO, enums.MessageMediaType.DOCUMENT]:
-                    unsupported += 1
-                    continue
-                media = getattr(message, message.media.value, None)
-                if not media:
-                    unsupported += 1
-                    continue
-                elif not (str(media.file_name).lower()).endswith(tuple(INDEX_EXTENSIONS)):
-                    unsupported += 1
-                    continue
-                media.file_type = message.media.value
-                media.caption = message.caption
-                sts = await save_file(media)
-                if sts:
-                    total_files += 1
-                elif sts == 0:
-                    duplicate += 1
-                elif sts == 2:
-                    errors += 1       
+            counts['saved'], counts['duplicate'], errors = await save_files(medias)
+            counts['errors'] += errors
         except Exception as e:
             logger.exception(e)
-            await msg.edit(f"❌ Error: {e}")
-        else:
-            await msg.edit(
-                f"✅ Successfully Saved <code>{total_files}</code> To Database!\n"
-                f"Duplicate Files Skipped: <code>{duplicate}</code>\n"
-                f"Deleted Messages Skipped: <code>{deleted}</code>\n"
-                f"Non-Media Messages Skipped: <code>{no_media + unsupported}</code>(Unsupported Media - `{unsupported}` )\n"
-                f"Errors Occurred: <code>{errors}</code>"
-                )
-            
+            counts['errors'] += len(medias)
+        for name, count in counts.items():
+            stats[name] += count
+        done[end] = counts
+        checkpoint = None
+        while pending and pending[0] in done:
+            checkpoint = pending.popleft()
+            for name, count in done.pop(checkpoint).items():
+                checkpoint_stats[name] += count
+        if checkpoint is not None:
+            checkpoint_stats['fetched'] = checkpoint
+            try:
+                await db.update_index_job(job['_id'], current=checkpoint, owner=JOB_OWNER, stats=checkpoint_stats)
+            except Exception as e:
+                # The next checkpoint covers this one
+                logger.warning(f"Failed to save indexing checkpoint: {e}")
+
+async def edit_status(bot, job, text, reply_markup=None):
+    try:
+        await bot.edit_message_text(job['status_chat_id'], job['status_msg_id'], text, reply_markup=reply_markup)
+    except FloodWait as t:
+        await asyncio.sleep(t.value)
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logger.warning(f"Failed to edit indexing status: {e}")
+
+async def report_progress(bot, job, stats):
+    can = [[InlineKeyboardButton('Cancel', callback_data='index_cancel')]]
+    reply = InlineKeyboardMarkup(can)
+    while True:
+        await asyncio.sleep(INDEX_PROGRESS_INTERVAL)
+        await edit_status(bot, job, index_status(stats), reply)
+
+async def keep_lease(job):
+    """Renew the claim on a job while it is indexed, stop when another process took it over"""
+    while True:
+        await asyncio.sleep(JOB_LEASE / 3)
+        try:
+            if not await db.renew_index_job(job['_id'], JOB_OWNER, JOB_LEASE):
+                logger.warning(f"Indexing of {job['chat']} was taken over by another process, stopping")
+                temp.CANCEL = True
+                return
+        except Exception as e:
+            logger.warning(f"Failed to renew indexing job lease: {e}")
+
+async def run_index_jobs(bot):
+    """Work through the indexing jobs stored in the database one at a time"""
+    while True:
+        jobs_added.clear()
+        try:
+            job = await db.claim_index_job(JOB_OWNER, JOB_LEASE)
+        except Exception as e:
+            logger.exception(f"Failed to get the next indexing job: {e}")
+            await asyncio.sleep(5)
+            continue
+        if not job:
+            # Also look again now and then for jobs whose owner stopped renewing its lease
+            try:
+                await asyncio.wait_for(jobs_added.wait(), JOB_LEASE)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        if job['state'] == 'running':
+            logger.info(f"Resuming indexing of {job['chat']} from message {job['current']}")
+        try:
+            await index_files_to_db(job, bot)
+        except Exception as e:
+            logger.exception(f"Indexing of {job['chat']} failed: {e}")
+            try:
+                await db.update_index_job(job['_id'], owner=JOB_OWNER, state='failed', error=str(e))
+            except Exception:
+                # Still running in the database, it is resumed on the next try
+                await asyncio.sleep(5)
+
+def start_index_jobs(bot):
+    """Start the indexing job runner unless it is already running"""
+    global runner
+    if runner is None or runner.done():
+        runner = asyncio.create_task(run_index_jobs(bot))
+
+async def index_files_to_db(job, bot):
+    stats = dict(saved=0, duplicate=0, errors=0, deleted=0, no_media=0, unsupported=0)
+    stats.update(job.get('stats', {}))
+    stats['fetched'] = job['current']
+    checkpoint_stats = dict(stats)
+    # Telegram fetches, normalization and Mongo writes overlap: the fetcher
+    # fills a bounded queue of message batches that the writers drain.
+    queue = asyncio.Queue(maxsize=INDEX_QUEUE_SIZE)
+    pending = deque()
+    done = {}
+    temp.CANCEL = False
+    workers = [asyncio.create_task(write_files(job, queue, stats, checkpoint_stats, pending, done)) for _ in range(INDEX_WORKERS)]
+    reporter = asyncio.create_task(report_progress(bot, job, stats))
+    lease = asyncio.create_task(keep_lease(job))
+    try:
+        await fetch_messages(bot, job, queue, stats, pending)
+    except Exception as e:
+        logger.exception(e)
+        error = e
+    else:
+        error = None
+    finally:
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        reporter.cancel()
+        lease.cancel()
+    if error:
+        await db.update_index_job(job['_id'], owner=JOB_OWNER, state='failed', error=str(error), stats=stats)
+        await edit_status(bot, job, f"❌ Error: {error}\n\n{index_status(stats)}")
+    elif temp.CANCEL:
+        await db.update_index_job(job['_id'], owner=JOB_OWNER, state='cancelled', stats=stats)
+        await edit_status(bot, job, f"Successfully Cancelled!!\n\n{index_status(stats)}")
+    else:
+        await db.update_index_job(job['_id'], owner=JOB_OWNER, state='done', stats=stats)
+        await edit_status(bot, job, f"✅ Successfully Indexed!\n\n{index_status(stats)}")
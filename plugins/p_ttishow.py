@@ -7,6 +7,7 @@ from pyrogram.errors.exceptions.bad_request_400 import MessageTooLong
 from info import ADMINS, LOG_CHANNEL, PICS, SUPPORT_LINK, UPDATES_LINK
 from database.users_chats_db import db
 from utils import temp, get_settings
+from web.worker import stop_stream_workers
 from Script import script
 
 
@@ -42,6 +43,8 @@ async def restart_bot(bot, message):
     msg = await message.reply("Restarting...")
     with open('restart.txt', 'w+') as file:
         file.write(f"{msg.chat.id}\n{msg.id}")
+    # Free PORT for the workers the restarted bot starts
+    await stop_stream_workers()
     os.execl(sys.executable, sys.executable, "bot.py")
 
 @Client.on_message(filters.command('leave') & filters.user(ADMINS))
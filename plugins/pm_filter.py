@@ -8,17 +8,38 @@ from datetime import datetime, timedelta
 from info import ADMINS, URL, MAX_BTN, BIN_CHANNEL, IS_STREAM, DELETE_TIME, FILMS_LINK, LOG_CHANNEL, SUPPORT_GROUP, SUPPORT_LINK, UPDATES_LINK, LANGUAGES, PAYMENT_QR, QUALITY, OWNER_UPI_ID, OWNER_USERNAME
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputMediaPhoto
 from pyrogram import Client, filters, enums
-from utils import get_size, is_subscribed, is_check_admin, get_wish, get_shortlink, get_readable_time, get_poster, temp, get_settings, save_group_settings
+from utils import get_size, is_subscribed, is_check_admin, get_wish, get_shortlink, warm_shortlinks, get_readable_time, get_poster, temp, get_settings, save_group_settings
 from database.users_chats_db import db
-from database.ia_filterdb import Media, get_search_results,delete_files
+from database.ia_filterdb import Media, get_search_results, delete_files, invalidate_search_cache, search_cache
 
-BUTTONS = {}
-CAP = {}
+
+def to_base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    text = ''
+    while True:
+        number, rest = divmod(number, 36)
+        text = digits[rest] + text
+        if not number:
+            return text
+
+def get_cursor(files, back=False):
+    """Keyset cursor continuing after the last file, or before the first file with back"""
+    file = files[0] if back else files[-1]
+    if file.indexed_at is None:
+        return ''
+    return ('b' if back else 'a') + to_base36(file.indexed_at)
+
+def parse_cursor(cursor):
+    """Turn a callback cursor back into get_search_results keyword arguments"""
+    try:
+        value = int(cursor[1:], 36)
+    except ValueError:
+        return {}
+    return {'before': value} if cursor[0] == 'b' else {'after': value}
 
 @Client.on_message(filters.private & filters.text & filters.incoming)
 async def pm_search(client, message):
     bot_id = client.me.id
-    files, n_offset, total = await get_search_results(message.text)
     btn = [[
         InlineKeyboardButton("🗂 ᴄʟɪᴄᴋ ʜᴇʀᴇ 🗂", url=FILMS_LINK)
     ]]
@@ -33,6 +54,7 @@ async def pm_search(client, message):
             return await auto_filter(client, message, s)
         await auto_filter(client, message, s)
     else:
+        files, n_offset, total = await get_search_results(message.text)
         if int(total) != 0:
             await message.reply_text(f'<b><i>🤗 ᴛᴏᴛᴀʟ <code>{total}</code> ʀᴇꜱᴜʟᴛꜱ ꜰᴏᴜɴᴅ ɪɴ ᴛʜɪꜱ ɢʀᴏᴜᴘ 👇</i></b>', reply_markup=reply_markup)
         else:
@@ -121,20 +143,22 @@ async def group_search(client, message):
 
 @Client.on_callback_query(filters.regex(r"^next"))
 async def next_page(bot, query):
-    ident, req, key, offset = query.data.split("_")
+    ident, req, key, offset, *cursor = query.data.split("_")
     if int(req) not in [query.from_user.id, 0]:
         return await query.answer(f"Hello {query.from_user.first_name},\nDon't Click Other Results!", show_alert=True)
     try:
         offset = int(offset)
     except:
         offset = 0
-    search = BUTTONS.get(key)
-    cap = CAP.get(key)
+    session = await temp.SEARCHES.get(key)
+    search = session.get('search')
+    cap = session.get('cap')
     if not search:
         await query.answer(f"Hello {query.from_user.first_name},\nSend New Request Again!", show_alert=True)
         return
 
-    files, n_offset, total = await get_search_results(search, offset=offset)
+    cursor = parse_cursor(cursor[0]) if cursor and cursor[0] else {}
+    files, n_offset, total = await get_search_results(search, offset=offset, **cursor)
     try:
         n_offset = int(n_offset)
     except:
@@ -142,7 +166,9 @@ async def next_page(bot, query):
 
     if not files:
         return
-    temp.FILES[key] = files
+    next_cursor = get_cursor(files)
+    back_cursor = get_cursor(files, back=True)
+    await temp.SEARCHES.update(key, files=[file.file_id for file in files])
     settings = await get_settings(query.message.chat.id)
     del_msg = f"\n\n<b>⚠️ ᴛʜɪs ᴍᴇssᴀɢᴇ ᴡɪʟʟ ʙᴇ ᴀᴜᴛᴏ ᴅᴇʟᴇᴛᴇ ᴀꜰᴛᴇʀ <code>{get_readable_time(DELETE_TIME)}</code> ᴛᴏ ᴀᴠᴏɪᴅ ᴄᴏᴘʏʀɪɢʜᴛ ɪssᴜᴇs</b>" if settings["auto_delete"] else ''
     files_link = ''
@@ -183,21 +209,23 @@ async def next_page(bot, query):
     else:
         off_set = offset - MAX_BTN
         
+    if off_set == 0:
+        back_cursor = ''
     if n_offset == 0:
         btn.append(
-            [InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"next_{req}_{key}_{off_set}"),
+            [InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"next_{req}_{key}_{off_set}_{back_cursor}"),
              InlineKeyboardButton(f"{math.ceil(int(offset) / MAX_BTN) + 1}/{math.ceil(total / MAX_BTN)}", callback_data="buttons")]
         )
     elif off_set is None:
         btn.append(
             [InlineKeyboardButton(f"{math.ceil(int(offset) / MAX_BTN) + 1}/{math.ceil(total / MAX_BTN)}", callback_data="buttons"),
-             InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"next_{req}_{key}_{n_offset}")])
+             InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"next_{req}_{key}_{n_offset}_{next_cursor}")])
     else:
         btn.append(
             [
-                InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"next_{req}_{key}_{off_set}"),
+                InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"next_{req}_{key}_{off_set}_{back_cursor}"),
                 InlineKeyboardButton(f"{math.ceil(int(offset) / MAX_BTN) + 1}/{math.ceil(total / MAX_BTN)}", callback_data="buttons"),
-                InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"next_{req}_{key}_{n_offset}")
+                InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"next_{req}_{key}_{n_offset}_{next_cursor}")
             ]
         )
     await query.message.edit_text(cap + files_link + del_msg, reply_markup=InlineKeyboardMarkup(btn), disable_web_page_preview=True, parse_mode=enums.ParseMode.HTML)
@@ -234,8 +262,9 @@ async def filter_languages_cb_handler(client: Client, query: CallbackQuery):
     if int(req) != query.from_user.id:
         return await query.answer(f"Hello {query.from_user.first_name},\nDon't Click Other Results!", show_alert=True)
 
-    search = BUTTONS.get(key)
-    cap = CAP.get(key)
+    session = await temp.SEARCHES.get(key)
+    search = session.get('search')
+    cap = session.get('cap')
     if not search:
         await query.answer(f"Hello {query.from_user.first_name},\nSend New Request Again!", show_alert=True)
         return 
@@ -244,7 +273,7 @@ async def filter_languages_cb_handler(client: Client, query: CallbackQuery):
     if not files:
         await query.answer(f"sᴏʀʀʏ '{lang.title()}' ʟᴀɴɢᴜᴀɢᴇ ꜰɪʟᴇs ɴᴏᴛ ꜰᴏᴜɴᴅ 😕", show_alert=1)
         return
-    temp.FILES[key] = files
+    await temp.SEARCHES.update(key, files=[file.file_id for file in files])
     settings = await get_settings(query.message.chat.id)
     del_msg = f"\n\n<b>⚠️ ᴛʜɪs ᴍᴇssᴀɢᴇ ᴡɪʟʟ ʙᴇ ᴀᴜᴛᴏ ᴅᴇʟᴇᴛᴇ ᴀꜰᴛᴇʀ <code>{get_readable_time(DELETE_TIME)}</code> ᴛᴏ ᴀᴠᴏɪᴅ ᴄᴏᴘʏʀɪɢʜᴛ ɪssᴜᴇs</b>" if settings["auto_delete"] else ''
     files_link = ''
@@ -279,31 +308,36 @@ async def filter_languages_cb_handler(client: Client, query: CallbackQuery):
     if l_offset != "":
         btn.append(
             [InlineKeyboardButton(text=f"1/{math.ceil(int(total_results) / MAX_BTN)}", callback_data="buttons"),
-             InlineKeyboardButton(text="ɴᴇxᴛ »", callback_data=f"lang_next#{req}#{key}#{lang}#{l_offset}#{offset}")]
+             InlineKeyboardButton(text="ɴᴇxᴛ »", callback_data=f"lang_next#{req}#{key}#{LANGUAGES.index(lang)}#{l_offset}#{get_cursor(files)}")]
         )
     btn.append([InlineKeyboardButton(text="⪻ ʙᴀᴄᴋ ᴛᴏ ᴍᴀɪɴ ᴘᴀɢᴇ", callback_data=f"next_{req}_{key}_{offset}")])
     await query.message.edit_text(cap + files_link + del_msg, disable_web_page_preview=True, reply_markup=InlineKeyboardMarkup(btn), parse_mode=enums.ParseMode.HTML)
 
 @Client.on_callback_query(filters.regex(r"^lang_next"))
 async def lang_next_page(bot, query):
-    ident, req, key, lang, l_offset, offset = query.data.split("#")
+    ident, req, key, lang, l_offset, cursor = query.data.split("#")
     if int(req) != query.from_user.id:
         return await query.answer(f"Hello {query.from_user.first_name},\nDon't Click Other Results!", show_alert=True)
     try:
         l_offset = int(l_offset)
     except:
         l_offset = 0
-    search = BUTTONS.get(key)
-    cap = CAP.get(key)
+    lang = LANGUAGES[int(lang)]
+    session = await temp.SEARCHES.get(key)
+    search = session.get('search')
+    cap = session.get('cap')
     settings = await get_settings(query.message.chat.id)
     del_msg = f"\n\n<b>⚠️ ᴛʜɪs ᴍᴇssᴀɢᴇ ᴡɪʟʟ ʙᴇ ᴀᴜᴛᴏ ᴅᴇʟᴇᴛᴇ ᴀꜰᴛᴇʀ <code>{get_readable_time(DELETE_TIME)}</code> ᴛᴏ ᴀᴠᴏɪᴅ ᴄᴏᴘʏʀɪɢʜᴛ ɪssᴜᴇs</b>" if settings["auto_delete"] else ''
     if not search:
         await query.answer(f"Hello {query.from_user.first_name},\nSend New Request Again!", show_alert=True)
         return
-    files, n_offset, total = await get_search_results(search, offset=l_offset, lang=lang)
+    cursor = parse_cursor(cursor) if cursor else {}
+    files, n_offset, total = await get_search_results(search, offset=l_offset, lang=lang, **cursor)
     if not files:
         return
-    temp.FILES[key] = files
+    next_cursor = get_cursor(files)
+    back_cursor = get_cursor(files, back=True)
+    await temp.SEARCHES.update(key, files=[file.file_id for file in files])
     try:
         n_offset = int(n_offset)
     except:
@@ -337,27 +371,29 @@ async def lang_next_page(bot, query):
         )
     if 0 < l_offset <= MAX_BTN:
         b_offset = 0
+        back_cursor = ''
     elif l_offset == 0:
         b_offset = None
     else:
         b_offset = l_offset - MAX_BTN
+    index = LANGUAGES.index(lang)
     if n_offset == 0:
         btn.append(
-            [InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"lang_next#{req}#{key}#{lang}#{b_offset}#{offset}"),
+            [InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"lang_next#{req}#{key}#{index}#{b_offset}#{back_cursor}"),
              InlineKeyboardButton(f"{math.ceil(int(l_offset) / MAX_BTN) + 1}/{math.ceil(total / MAX_BTN)}", callback_data="buttons")]
         )
     elif b_offset is None:
         btn.append(
             [InlineKeyboardButton(f"{math.ceil(int(l_offset) / MAX_BTN) + 1}/{math.ceil(total / MAX_BTN)}", callback_data="buttons"),
-             InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"lang_next#{req}#{key}#{lang}#{n_offset}#{offset}")]
+             InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"lang_next#{req}#{key}#{index}#{n_offset}#{next_cursor}")]
         )
     else:
         btn.append(
-            [InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"lang_next#{req}#{key}#{lang}#{b_offset}#{offset}"),
+            [InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"lang_next#{req}#{key}#{index}#{b_offset}#{back_cursor}"),
              InlineKeyboardButton(f"{math.ceil(int(l_offset) / MAX_BTN) + 1}/{math.ceil(total / MAX_BTN)}", callback_data="buttons"),
-             InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"lang_next#{req}#{key}#{lang}#{n_offset}#{offset}")]
+             InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"lang_next#{req}#{key}#{index}#{n_offset}#{next_cursor}")]
         )
-    btn.append([InlineKeyboardButton(text="⪻ ʙᴀᴄᴋ ᴛᴏ ᴍᴀɪɴ ᴘᴀɢᴇ", callback_data=f"next_{req}_{key}_{offset}")])
+    btn.append([InlineKeyboardButton(text="⪻ ʙᴀᴄᴋ ᴛᴏ ᴍᴀɪɴ ᴘᴀɢᴇ", callback_data=f"next_{req}_{key}_0")])
     await query.message.edit_text(cap + files_link + del_msg, reply_markup=InlineKeyboardMarkup(btn), disable_web_page_preview=True, parse_mode=enums.ParseMode.HTML)
 
 @Client.on_callback_query(filters.regex(r"^qual_search"))
@@ -365,16 +401,17 @@ async def quality_search(client: Client, query: CallbackQuery):
     _, qual, key, offset, req = query.data.split("#")
     if int(req) != query.from_user.id:
         return await query.answer(f"Hello {query.from_user.first_name},\nDon't Click Other Results!", show_alert=True)
-    search = BUTTONS.get(key)
-    cap = CAP.get(key)
+    session = await temp.SEARCHES.get(key)
+    search = session.get('search')
+    cap = session.get('cap')
     if not search:
         await query.answer(f"Hello {query.from_user.first_name},\nSend New Request Again!", show_alert=True)
         return
-    files, l_offset, total_results = await get_search_results(search, lang=qual)
+    files, l_offset, total_results = await get_search_results(search, quality=qual)
     if not files:
         await query.answer(f"sᴏʀʀʏ '{qual.title()}' ʟᴀɴɢᴜᴀɢᴇ ꜰɪʟᴇs ɴᴏᴛ ꜰᴏᴜɴᴅ 😕", show_alert=1)
         return
-    temp.FILES[key] = files
+    await temp.SEARCHES.update(key, files=[file.file_id for file in files])
     settings = await get_settings(query.message.chat.id)
     del_msg = f"\n\n<b>⚠️ ᴛʜɪs ᴍᴇssᴀɢᴇ ᴡɪʟʟ ʙᴇ ᴀᴜᴛᴏ ᴅᴇʟᴇᴛᴇ ᴀꜰᴛᴇʀ <code>{get_readable_time(DELETE_TIME)}</code> ᴛᴏ ᴀᴠᴏɪᴅ ᴄᴏᴘʏʀɪɢʜᴛ ɪssᴜᴇs</b>" if settings["auto_delete"] else ''
     files_link = ''
@@ -401,31 +438,36 @@ async def quality_search(client: Client, query: CallbackQuery):
     if l_offset != "":
         btn.append(
             [InlineKeyboardButton(text=f"1/{math.ceil(int(total_results) / MAX_BTN)}", callback_data="buttons"),
-             InlineKeyboardButton(text="ɴᴇxᴛ »", callback_data=f"qual_next#{req}#{key}#{qual}#{l_offset}#{offset}")]
+             InlineKeyboardButton(text="ɴᴇxᴛ »", callback_data=f"qual_next#{req}#{key}#{QUALITY.index(qual)}#{l_offset}#{get_cursor(files)}")]
         )
     btn.append([InlineKeyboardButton(text="⪻ ʙᴀᴄᴋ ᴛᴏ ᴍᴀɪɴ ᴘᴀɢᴇ", callback_data=f"next_{req}_{key}_{offset}")])
     await query.message.edit_text(cap + files_link + del_msg, disable_web_page_preview=True, reply_markup=InlineKeyboardMarkup(btn), parse_mode=enums.ParseMode.HTML)
 
 @Client.on_callback_query(filters.regex(r"^qual_next"))
 async def quality_next_page(bot, query):
-    ident, req, key, qual, l_offset, offset = query.data.split("#")
+    ident, req, key, qual, l_offset, cursor = query.data.split("#")
     if int(req) != query.from_user.id:
         return await query.answer(f"Hello {query.from_user.first_name},\nDon't Click Other Results!", show_alert=True)
     try:
         l_offset = int(l_offset)
     except:
         l_offset = 0
-    search = BUTTONS.get(key)
-    cap = CAP.get(key)
+    qual = QUALITY[int(qual)]
+    session = await temp.SEARCHES.get(key)
+    search = session.get('search')
+    cap = session.get('cap')
     settings = await get_settings(query.message.chat.id)
     del_msg = f"\n\n<b>⚠️ ᴛʜɪs ᴍᴇssᴀɢᴇ ᴡɪʟʟ ʙᴇ ᴀᴜᴛᴏ ᴅᴇʟᴇᴛᴇ ᴀꜰᴛᴇʀ <code>{get_readable_time(DELETE_TIME)}</code> ᴛᴏ ᴀᴠᴏɪᴅ ᴄᴏᴘʏʀɪɢʜᴛ ɪssᴜᴇs</b>" if settings["auto_delete"] else ''
     if not search:
         await query.answer(f"Hello {query.from_user.first_name},\nSend New Request Again!", show_alert=True)
         return
-    files, n_offset, total = await get_search_results(search, offset=l_offset, lang=qual)
+    cursor = parse_cursor(cursor) if cursor else {}
+    files, n_offset, total = await get_search_results(search, offset=l_offset, quality=qual, **cursor)
     if not files:
         return
-    temp.FILES[key] = files
+    next_cursor = get_cursor(files)
+    back_cursor = get_cursor(files, back=True)
+    await temp.SEARCHES.update(key, files=[file.file_id for file in files])
     try:
         n_offset = int(n_offset)
     except:
@@ -453,27 +495,29 @@ async def quality_next_page(bot, query):
         )
     if 0 < l_offset <= MAX_BTN:
         b_offset = 0
+        back_cursor = ''
     elif l_offset == 0:
         b_offset = None
     else:
         b_offset = l_offset - MAX_BTN
+    index = QUALITY.index(qual)
     if n_offset == 0:
         btn.append(
-            [InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"qual_next#{req}#{key}#{qual}#{b_offset}#{offset}"),
+            [InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"qual_next#{req}#{key}#{index}#{b_offset}#{back_cursor}"),
              InlineKeyboardButton(f"{math.ceil(int(l_offset) / MAX_BTN) + 1}/{math.ceil(total / MAX_BTN)}", callback_data="buttons")]
         )
     elif b_offset is None:
         btn.append(
             [InlineKeyboardButton(f"{math.ceil(int(l_offset) / MAX_BTN) + 1}/{math.ceil(total / MAX_BTN)}", callback_data="buttons"),
-             InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"qual_next#{req}#{key}#{qual}#{n_offset}#{offset}")]
+             InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"qual_next#{req}#{key}#{index}#{n_offset}#{next_cursor}")]
         )
     else:
         btn.append(
-            [InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"qual_next#{req}#{key}#{qual}#{b_offset}#{offset}"),
+            [InlineKeyboardButton("« ʙᴀᴄᴋ", callback_data=f"qual_next#{req}#{key}#{index}#{b_offset}#{back_cursor}"),
              InlineKeyboardButton(f"{math.ceil(int(l_offset) / MAX_BTN) + 1}/{math.ceil(total / MAX_BTN)}", callback_data="buttons"),
-             InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"qual_next#{req}#{key}#{qual}#{n_offset}#{offset}")]
+             InlineKeyboardButton("ɴᴇxᴛ »", callback_data=f"qual_next#{req}#{key}#{index}#{n_offset}#{next_cursor}")]
         )
-    btn.append([InlineKeyboardButton(text="⪻ ʙᴀᴄᴋ ᴛᴏ ᴍᴀɪɴ ᴘᴀɢᴇ", callback_data=f"next_{req}_{key}_{offset}")])
+    btn.append([InlineKeyboardButton(text="⪻ ʙᴀᴄᴋ ᴛᴏ ᴍᴀɪɴ ᴘᴀɢᴇ", callback_data=f"next_{req}_{key}_0")])
     await query.message.edit_text(cap + files_link + del_msg, reply_markup=InlineKeyboardMarkup(btn), disable_web_page_preview=True, parse_mode=enums.ParseMode.HTML)
 
 @Client.on_callback_query(filters.regex(r"^spolling"))
@@ -482,6 +526,8 @@ async def advantage_spoll_choker(bot, query):
     if int(user) != 0 and query.from_user.id != int(user):
         return await query.answer(f"Hello {query.from_user.first_name},\nDon't Click Other Results!", show_alert=True)
     movie = await get_poster(id, id=True)
+    if not movie:
+        return await query.answer("IMDb is slow right now, try again in a moment.", show_alert=True)
     search = movie.get('title')
     s = await query.message.edit_text(f"<b><i><code>{search}</code> Check In My Database...</i></b>")
     await query.answer('')
@@ -654,7 +700,7 @@ async def cb_handler(client: Client, query: CallbackQuery):
         buttons = [[
             InlineKeyboardButton('« ʙᴀᴄᴋ', callback_data='about')
         ]]
-        await query.message.edit_text(script.STATUS_TXT.format(files, users, chats, premium, u_size, f_size, uptime), reply_markup=InlineKeyboardMarkup(buttons)
+        await query.message.edit_text(script.STATUS_TXT.format(files, users, chats, premium, u_size, f_size, search_cache.hits, search_cache.misses, uptime), reply_markup=InlineKeyboardMarkup(buttons)
         )
         
     elif query.data == "owner":
@@ -796,6 +842,7 @@ async def cb_handler(client: Client, query: CallbackQuery):
         files = await Media.count_documents()
         await query.answer('Deleting...')
         await Media.collection.drop()
+        invalidate_search_cache()
         await query.message.edit_text(f"Successfully deleted {files} files")
         
     elif query.data.startswith("delete"):
@@ -806,13 +853,14 @@ async def cb_handler(client: Client, query: CallbackQuery):
         async for file in files:
             await Media.collection.delete_one({'_id': file.file_id})
             deleted += 1
+        invalidate_search_cache()
         await query.message.edit(f'Deleted {deleted} files in your database in your query {query_}')
      
     elif query.data.startswith("send_all"):
         ident, key, req = query.data.split("#")
         if int(req) != query.from_user.id:
             return await query.answer(f"Hello {query.from_user.first_name},\nDon't Click Other Results!", show_alert=True)        
-        files = temp.FILES.get(key)
+        files = (await temp.SEARCHES.get(key)).get('files')
         if not files:
             await query.answer(f"Hello {query.from_user.first_name},\nSend New Request Again!", show_alert=True)
             return        
@@ -935,8 +983,9 @@ async def auto_filter(client, msg, s, spoll=False):
         search, files, offset, total_results = spoll
     req = message.from_user.id if message and message.from_user else 0
     key = f"{message.chat.id}-{message.id}"
-    temp.FILES[key] = files
-    BUTTONS[key] = search
+    if settings['shortlink']:
+        # Opening a file from these results then finds its shortlink ready
+        warm_shortlinks(settings['url'], settings['api'], [f"https://t.me/{temp.U_NAME}?start=shortlink_{message.chat.id}_{file.file_id}" for file in files])
     files_link = ""
     if settings['links']:
         btn = []
@@ -969,7 +1018,7 @@ async def auto_filter(client, msg, s, spoll=False):
             )
         btn.append(
             [InlineKeyboardButton(text=f"1/{math.ceil(int(total_results) / MAX_BTN)}", callback_data="buttons"),
-             InlineKeyboardButton(text="ɴᴇxᴛ »", callback_data=f"next_{req}_{key}_{offset}")]
+             InlineKeyboardButton(text="ɴᴇxᴛ »", callback_data=f"next_{req}_{key}_{offset}_{get_cursor(files)}")]
         )
     else:
         if settings['shortlink'] and not await db.has_premium_access(message.from_user.id):
@@ -1018,7 +1067,8 @@ async def auto_filter(client, msg, s, spoll=False):
         )
     else:
         cap = f"<b>💭 ʜᴇʏ {message.from_user.mention},\n♻️ ʜᴇʀᴇ ɪ ꜰᴏᴜɴᴅ ꜰᴏʀ ʏᴏᴜʀ sᴇᴀʀᴄʜ {search}...</b>"
-    CAP[key] = cap
+    # Written once the caption is known, before the buttons using it are sent
+    await temp.SEARCHES.create(key, search=search, files=[file.file_id for file in files], cap=cap)
     del_msg = f"\n\n<b>⚠️ ᴛʜɪs ᴍᴇssᴀɢᴇ ᴡɪʟʟ ʙᴇ ᴀᴜᴛᴏ ᴅᴇʟᴇᴛᴇ ᴀꜰᴛᴇʀ <code>{get_readable_time(DELETE_TIME)}</code> ᴛᴏ ᴀᴠᴏɪᴅ ᴄᴏᴘʏʀɪɢʜᴛ ɪssᴜᴇs</b>" if settings["auto_delete"] else ''
     if imdb and imdb.get('poster'):
         await s.delete()
@@ -1090,7 +1140,7 @@ async def advantage_spell_chok(message, s):
         return
     user = message.from_user.id if message.from_user else 0
     buttons = [[
-        InlineKeyboardButton(text=movie.get('title'), callback_data=f"spolling#{movie.movieID}#{user}")
+        InlineKeyboardButton(text=movie.get('title'), callback_data=f"spolling#{movie['movieID']}#{user}")
     ]
         for movie in movies
     ]
@@ -1,16 +1,122 @@
 from pyrogram.errors import UserNotParticipant, FloodWait
-from info import LONG_IMDB_DESCRIPTION
+from info import LONG_IMDB_DESCRIPTION, SETTINGS_CACHE_SIZE, SETTINGS_CACHE_TTL, SETTINGS_POLL_INTERVAL, IMDB_CACHE_SIZE, IMDB_CACHE_TTL, IMDB_WORKERS, IMDB_TIMEOUT, SEARCH_SESSION_SIZE, SEARCH_SESSION_TTL, SEARCH_SESSION_DB, SHORTLINK_CACHE_SIZE, SHORTLINK_CACHE_TTL, SHORTLINK_TIMEOUT
 from imdb import Cinemagoer
 import asyncio
+import aiohttp
 from pyrogram.types import InlineKeyboardButton
 from pyrogram import enums
 import pytz
 import re, os
+import hashlib
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from database.users_chats_db import db
 from shortzy import Shortzy
 
 imdb = Cinemagoer() 
+logger = logging.getLogger(__name__)
+
+class TTLCache(object):
+    """Size bounded mapping that drops the least recently used and expired entries"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None, count=True):
+        """The value of key, `count=False` leaves lookups made for internal use out of hits and misses"""
+        item = self._data.get(key)
+        if item is not None and item[0] < time.monotonic():
+            del self._data[key]
+            item = None
+        if item is None:
+            self.misses += count
+            return default
+        self._data.move_to_end(key)
+        self.hits += count
+        return item[1]
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def keys(self):
+        return list(self._data)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def __len__(self):
+        return len(self._data)
+
+class SingleFlight(object):
+    """Concurrent calls with the same key share one running task instead of repeating the work"""
+
+    def __init__(self):
+        self.calls = {}
+
+    def done(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        # Every waiter may have gone, the failure is theirs to see, not the loop's
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, func, timeout=None):
+        """Await func() or the call already running for key, waiters may time out without cancelling it"""
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self.calls[key] = task
+            task.add_done_callback(lambda task: self.done(key, task))
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+
+class SessionStore(object):
+    """Search sessions of result messages, recent ones in memory and optionally all of them in the database"""
+
+    def __init__(self, maxsize, ttl, persist):
+        self.cache = TTLCache(maxsize, ttl)
+        self.persist = persist
+
+    async def get(self, key):
+        session = self.cache.get(key)
+        if session is None:
+            session = await db.get_search_session(key) if self.persist else {}
+            if session:
+                self.cache.set(key, session)
+        return session
+
+    async def create(self, key, **fields):
+        """Store the session of a new result message, there is nothing to read first"""
+        self.cache.set(key, fields)
+        if self.persist:
+            await db.update_search_session(key, fields)
+
+    async def update(self, key, **fields):
+        session = self.cache.get(key)
+        if session is not None:
+            self.cache.set(key, dict(session, **fields))
+        elif not self.persist:
+            self.cache.set(key, fields)
+        if self.persist:
+            # $set merges the fields, the next get reads the whole session
+            await db.update_search_session(key, fields)
 
 class temp(object):
     START_TIME = 0
@@ -20,10 +126,11 @@ class temp(object):
     CANCEL = False
     U_NAME = None
     B_NAME = None
-    SETTINGS = {}
+    SETTINGS = TTLCache(SETTINGS_CACHE_SIZE, SETTINGS_CACHE_TTL)
+    # Search, caption and file ids behind the buttons of every result message
+    SEARCHES = SessionStore(SEARCH_SESSION_SIZE, SEARCH_SESSION_TTL, SEARCH_SESSION_DB)
     CURRENT = int(os.environ.get("SKIP", 1))
     VERIFICATIONS = {}
-    FILES = {}
     USERS_CANCEL = False
     GROUPS_CANCEL = False
     BOT = None
@@ -42,37 +149,39 @@ async def is_subscribed(bot, query, channel):
             pass
     return btn
 
-async def get_poster(query, bulk=False, id=False, file=None):
-    if not id:
-        query = (query.strip()).lower()
-        title = query
-        year = re.findall(r'[1-2]\d{3}$', query, re.IGNORECASE)
-        if year:
-            year = list_to_str(year[:1])
-            title = (query.replace(year, "")).strip()
-        elif file is not None:
-            year = re.findall(r'[1-2]\d{3}', file, re.IGNORECASE)
-            if year:
-                year = list_to_str(year[:1]) 
-        else:
-            year = None
-        movieid = imdb.search_movie(title.lower(), results=10)
-        if not movieid:
-            return None
-        if year:
-            filtered=list(filter(lambda k: str(k.get('year')) == str(year), movieid))
-            if not filtered:
-                filtered = movieid
-        else:
-            filtered = movieid
-        movieid=list(filter(lambda k: k.get('kind') in ['movie', 'tv series'], filtered))
-        if not movieid:
-            movieid = filtered
-        if bulk:
-            return movieid
-        movieid = movieid[0].movieID
-    else:
-        movieid = query
+imdb_cache = TTLCache(IMDB_CACHE_SIZE, IMDB_CACHE_TTL)
+# Cinemagoer blocks on HTTP, it runs in its own threads and never on the event loop
+imdb_executor = ThreadPoolExecutor(max_workers=IMDB_WORKERS, thread_name_prefix='imdb')
+imdb_flight = SingleFlight()
+
+async def fetch_imdb(key, fetch):
+    data = await asyncio.get_running_loop().run_in_executor(imdb_executor, fetch)
+    try:
+        await db.set_imdb(key, data)
+    except Exception as e:
+        logger.error(f"Failed to cache IMDb data for {key}: {e}")
+    imdb_cache.set(key, data)
+    return data
+
+async def get_imdb_cached(key, fetch):
+    """IMDb data from memory, then from the database, and only then from IMDb"""
+    data = imdb_cache.get(key)
+    if data is not None:
+        return data
+    data = await db.get_imdb(key)
+    if data is not None:
+        imdb_cache.set(key, data)
+        return data
+    # The shared request still fills the cache when every waiter has timed out
+    return await imdb_flight.do(key, lambda: fetch_imdb(key, fetch), IMDB_TIMEOUT)
+
+def search_imdb(title):
+    return [
+        {'movieID': movie.movieID, 'title': movie.get('title'), 'year': movie.get('year'), 'kind': movie.get('kind')}
+        for movie in imdb.search_movie(title, results=10)
+    ]
+
+def get_imdb_movie(movieid):
     movie = imdb.get_movie(movieid)
     if movie.get("original air date"):
         date = movie["original air date"]
@@ -119,6 +228,48 @@ async def get_poster(query, bulk=False, id=False, file=None):
         'url':f'https://www.imdb.com/title/tt{movieid}'
     }
 
+async def get_poster(query, bulk=False, id=False, file=None):
+    if not id:
+        query = (query.strip()).lower()
+        title = query
+        year = re.findall(r'[1-2]\d{3}$', query, re.IGNORECASE)
+        if year:
+            year = list_to_str(year[:1])
+            title = (query.replace(year, "")).strip()
+        elif file is not None:
+            year = re.findall(r'[1-2]\d{3}', file, re.IGNORECASE)
+            if year:
+                year = list_to_str(year[:1]) 
+        else:
+            year = None
+        title = " ".join(title.lower().split())
+        try:
+            movieid = await get_imdb_cached(f"search:{title}", lambda: search_imdb(title))
+        except asyncio.TimeoutError:
+            logger.warning(f"IMDb search for {title} timed out")
+            return None
+        if not movieid:
+            return None
+        if year:
+            filtered=list(filter(lambda k: str(k.get('year')) == str(year), movieid))
+            if not filtered:
+                filtered = movieid
+        else:
+            filtered = movieid
+        movieid=list(filter(lambda k: k.get('kind') in ['movie', 'tv series'], filtered))
+        if not movieid:
+            movieid = filtered
+        if bulk:
+            return movieid
+        movieid = movieid[0]['movieID']
+    else:
+        movieid = query
+    try:
+        return await get_imdb_cached(f"movie:{movieid}", lambda: get_imdb_movie(movieid))
+    except asyncio.TimeoutError:
+        logger.warning(f"IMDb lookup of {movieid} timed out")
+        return None
+
 async def is_check_admin(bot, chat_id, user_id):
     try:
         member = await bot.get_chat_member(chat_id, user_id)
@@ -173,18 +324,43 @@ async def groups_broadcast_messages(chat_id, message, pin):
         return "Error"
 
 async def get_settings(group_id):
+    group_id = int(group_id)
     settings = temp.SETTINGS.get(group_id)
     if not settings:
         settings = await db.get_settings(group_id)
-        temp.SETTINGS.update({group_id: settings})
+        temp.SETTINGS.set(group_id, settings)
     return settings
     
 async def save_group_settings(group_id, key, value):
     current = await get_settings(group_id)
     current.update({key: value})
-    temp.SETTINGS.update({group_id: current})
+    temp.SETTINGS.set(int(group_id), current)
     await db.update_settings(group_id, current)
 
+async def watch_settings():
+    """Drop cached group settings as soon as any bot sharing the database changes them"""
+    try:
+        async with db.watch_settings() as stream:
+            async for change in stream:
+                group = change.get('fullDocument')
+                if group:
+                    temp.SETTINGS.pop(group['id'])
+                else:
+                    # Deleted groups only carry their _id, start over
+                    temp.SETTINGS.clear()
+    except Exception as e:
+        # Change streams need a replica set, poll the settings version instead
+        logger.warning(f"Settings change stream unavailable, polling every {SETTINGS_POLL_INTERVAL}s: {e}")
+    since = await db.get_settings_version()
+    while True:
+        await asyncio.sleep(SETTINGS_POLL_INTERVAL)
+        try:
+            async for group in db.get_changed_settings(since):
+                temp.SETTINGS.pop(group['id'])
+                since = max(since, group['updated_at'])
+        except Exception as e:
+            logger.error(f"Failed to poll settings changes: {e}")
+
 def get_size(size):
     units = ["Bytes", "KB", "MB", "GB", "TB", "PB", "EB"]
     size = float(size)
@@ -202,10 +378,69 @@ def list_to_str(k):
     else:
         return ', '.join(f'{elem}' for elem in k)
     
-async def get_shortlink(url, api, link):
+shortlink_flight = SingleFlight()
+shortlink_cache = TTLCache(SHORTLINK_CACHE_SIZE, SHORTLINK_CACHE_TTL)
+shortlink_session = None
+background_tasks = set()
+
+def get_shortlink_session():
+    # One connection pool for every shortener request instead of a client per link
+    global shortlink_session
+    if shortlink_session is None or shortlink_session.closed:
+        shortlink_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=SHORTLINK_TIMEOUT))
+    return shortlink_session
+
+async def convert_shortlink(url, api, link):
+    try:
+        async with get_shortlink_session().get(f'https://{url}/api', params={'api': api, 'url': link}) as resp:
+            resp.raise_for_status()
+            data = await resp.json(content_type=None)
+    except Exception as e:
+        logger.debug(f"Standard shortener API of {url} failed: {e}")
+        data = None
+    if isinstance(data, dict) and data.get('shortenedUrl'):
+        return data['shortenedUrl']
+    # Not the usual shortener API, Shortzy knows the sites that differ
     shortzy = Shortzy(api_key=api, base_site=url)
-    link = await shortzy.convert(link)
-    return link
+    return await shortzy.convert(link)
+
+async def fetch_shortlink(key, url, api, link):
+    short = await db.get_shortlink(key)
+    if not short:
+        short = await convert_shortlink(url, api, link)
+        await db.set_shortlink(key, short)
+    shortlink_cache.set(key, short)
+    return short
+
+async def get_shortlink(url, api, link, fallback=True, cache=True):
+    """Shortened link from the cache or the shortener, the link itself when the shortener fails
+
+    Links that are only opened once, like verify tokens, pass cache=False to
+    skip the memory and database caches.
+    """
+    # The key is stored as a database _id, so it holds a digest instead of the API key
+    key = f'{url}|{hashlib.sha256(api.encode()).hexdigest()[:16]}|{link}'
+    short = shortlink_cache.get(key) if cache else None
+    if short:
+        return short
+    try:
+        if not cache:
+            return await asyncio.wait_for(convert_shortlink(url, api, link), SHORTLINK_TIMEOUT)
+        return await shortlink_flight.do(key, lambda: fetch_shortlink(key, url, api, link), SHORTLINK_TIMEOUT)
+    except Exception as e:
+        if not fallback:
+            raise
+        logger.warning(f"Shortlink of {link} failed, sending it directly: {e}")
+        return link
+
+def warm_shortlinks(url, api, links):
+    """Shorten links in the background so they are cached before anyone opens them"""
+    async def warm():
+        for link in links:
+            await get_shortlink(url, api, link)
+    task = asyncio.create_task(warm())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
 def get_readable_time(seconds):
     periods = [('d', 86400), ('h', 3600), ('m', 60), ('s', 1)]
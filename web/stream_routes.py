@@ -1,14 +1,39 @@
-import math
+import hmac
 import secrets
 import mimetypes
-from info import BIN_CHANNEL
-from utils import temp
+from ipaddress import ip_address
 from aiohttp import web
-from web.utils.custom_dl import TGCustomYield, chunk_size, offset_fix
+from info import STREAM_WORKERS, TRUSTED_PROXY, METRICS_TOKEN
+from database.users_chats_db import db
+from web.utils.custom_dl import TGCustomYield, get_file_properties
+from web.utils.http_range import RangeNotSatisfiable, parse_range, if_range_matches, multipart_ranges
 from web.utils.render_template import media_watch
+from web.utils.scheduler import stream_scheduler, is_watch_token, WATCH, DOWNLOAD
 
 routes = web.RouteTableDef()
 
+
+def is_trusted_proxy(ip):
+    try:
+        address = ip_address(ip)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXY)
+
+
+def client_ip(request):
+    """The client's address, X-Forwarded-For is only believed from a TRUSTED_PROXY"""
+    ip = request.remote or ""
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded and is_trusted_proxy(ip):
+        # Each proxy appends the address it got the request from, the last one
+        # not added by a trusted proxy is the client
+        for ip in reversed([part.strip() for part in forwarded.split(",")]):
+            if not is_trusted_proxy(ip):
+                break
+    return ip
+
+
 @routes.get("/", allow_head=True)
 async def root_route_handler(request):
     return web.Response(text='<h1 align="center"><a href="https://t.me/Star_Bots_Tamil"><b>Star Bots Tamil</b></a></h1>', content_type='text/html')
@@ -22,6 +47,23 @@ async def watch_handler(request):
     except:
         return web.Response(text="<h1>Something went wrong</h1>", content_type='text/html')
 
+def can_read_metrics(request):
+    if METRICS_TOKEN:
+        return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}")
+    # The peer itself, a forwarded request from outside never counts as local
+    return request.remote in ("127.0.0.1", "::1") and "X-Forwarded-For" not in request.headers
+
+@routes.get("/metrics")
+async def metrics_handler(request):
+    if not can_read_metrics(request):
+        return web.Response(status=403, text="Forbidden")
+    metrics = stream_scheduler.metrics()
+    if STREAM_WORKERS:
+        # Each worker only sees its own streams, the others report through the database
+        workers = await db.get_stream_workers()
+        metrics['workers'] = [dict(worker['metrics'], worker=worker['_id'], pid=worker['pid']) for worker in workers]
+    return web.json_response(metrics)
+
 @routes.get("/download/{message_id}")
 async def download_handler(request):
     try:
@@ -32,46 +74,59 @@ async def download_handler(request):
         
 
 async def media_download(request, message_id: int):
-    range_header = request.headers.get('Range', 0)
-    media_msg = await temp.BOT.get_messages(BIN_CHANNEL, message_id)
-    file_properties = await TGCustomYield().generate_file_properties(media_msg)
+    file_properties = await get_file_properties(message_id)
     file_size = file_properties.file_size
 
-    if range_header:
-        from_bytes, until_bytes = range_header.replace('bytes=', '').split('-')
-        from_bytes = int(from_bytes)
-        until_bytes = int(until_bytes) if until_bytes else file_size - 1
-    else:
-        from_bytes = request.http_range.start or 0
-        until_bytes = request.http_range.stop or file_size - 1
-
-    req_length = until_bytes - from_bytes
-
-    new_chunk_size = await chunk_size(req_length)
-    offset = await offset_fix(from_bytes, new_chunk_size)
-    first_part_cut = from_bytes - offset
-    last_part_cut = (until_bytes % new_chunk_size) + 1
-    part_count = math.ceil(req_length / new_chunk_size)
-    body = TGCustomYield().yield_file(media_msg, offset, first_part_cut, last_part_cut, part_count,
-                                      new_chunk_size)
-
     file_name = file_properties.file_name if file_properties.file_name \
         else f"{secrets.token_hex(2)}.jpeg"
     mime_type = file_properties.mime_type if file_properties.mime_type \
-        else f"{mimetypes.guess_type(file_name)}"
-
-    return_resp = web.Response(
-        status=206 if range_header else 200,
-        body=body,
-        headers={
-            "Content-Type": mime_type,
-            "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-            "Content-Disposition": f'attachment; filename="{file_name}"',
-            "Accept-Ranges": "bytes",
-        }
-    )
-
-    if return_resp.status == 200:
-        return_resp.headers.add("Content-Length", str(file_size))
-
-    return return_resp
+        else mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    # A BIN_CHANNEL message always holds the same file, its id and size name the version
+    etag = f'"{file_properties.media_id:x}-{file_size:x}"'
+    headers = {
+        "Content-Type": mime_type,
+        "Content-Disposition": f'attachment; filename="{file_name}"',
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+    }
+
+    try:
+        ranges = parse_range(request.headers.get("Range"), file_size)
+    except RangeNotSatisfiable:
+        return web.Response(
+            status=416,
+            headers={"Content-Range": f"bytes */{file_size}", "Accept-Ranges": "bytes", "ETag": etag}
+        )
+    if ranges and not if_range_matches(request.headers.get("If-Range"), etag):
+        ranges = None
+
+    ip = client_ip(request)
+    priority = WATCH if is_watch_token(message_id, request.query.get("watch", "")) else DOWNLOAD
+
+    if not ranges:
+        headers["Content-Length"] = str(file_size)
+        body = TGCustomYield().yield_file(file_properties, 0, file_size - 1)
+        body = stream_scheduler.throttle(ip, priority, body)
+        return web.Response(status=200, body=body, headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        body = TGCustomYield().yield_file(file_properties, start, end)
+        body = stream_scheduler.throttle(ip, priority, body)
+        return web.Response(status=206, body=body, headers=headers)
+
+    boundary = secrets.token_hex(16)
+    parts, closing = multipart_ranges(ranges, file_size, mime_type, boundary)
+    headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    headers["Content-Length"] = str(sum(len(head) + end - start + 1 for head, start, end in parts) + len(closing))
+
+    async def body():
+        for head, start, end in parts:
+            yield head
+            async for chunk in TGCustomYield().yield_file(file_properties, start, end):
+                yield chunk
+        yield closing
+
+    return web.Response(status=206, body=stream_scheduler.throttle(ip, priority, body()), headers=headers)
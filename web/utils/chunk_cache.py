@@ -0,0 +1,117 @@
+import os
+import mmap
+import asyncio
+import logging
+from collections import OrderedDict
+from info import STREAM_CACHE_DIR, STREAM_CACHE_SIZE, STREAM_WORKERS, STREAM_WORKER
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkCache:
+    """Chunks of streamed files kept on disk, the least recently used are removed over `max_bytes`
+
+    The file work runs in the default executor so a slow disk never holds up
+    the event loop, the bookkeeping stays on the loop.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.files = OrderedDict()
+        self.writing = set()
+        if max_bytes > 0:
+            self.load()
+
+    def load(self):
+        """Pick up the chunks cached before a restart, oldest first"""
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.files[name] = size
+            self.size += size
+        self.remove(self.evict())
+        logger.info(f"Stream cache: {len(self.files)} chunks, {self.size} bytes")
+
+    @staticmethod
+    def name(media_id, offset):
+        return f"{media_id}_{offset}"
+
+    async def get(self, media_id, offset):
+        """A memory mapped view of the chunk, None when it is not cached"""
+        name = self.name(media_id, offset)
+        if name not in self.files:
+            return None
+        try:
+            view = await asyncio.get_running_loop().run_in_executor(None, self.map, name)
+        except (OSError, ValueError):
+            if name in self.files:
+                self.size -= self.files.pop(name)
+            return None
+        if name in self.files:
+            self.files.move_to_end(name)
+        return view
+
+    def map(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            # The map outlives the file object, it is unmapped once the view is freed
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def has(self, media_id, offset):
+        return self.name(media_id, offset) in self.files
+
+    async def set(self, media_id, offset, chunk):
+        if self.max_bytes <= 0 or not chunk:
+            return
+        name = self.name(media_id, offset)
+        if name in self.files or name in self.writing:
+            return
+        self.writing.add(name)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self.write, name, chunk)
+        except OSError as e:
+            logger.warning(f"Failed to cache chunk {name}: {e}")
+            return
+        finally:
+            self.writing.discard(name)
+        self.files[name] = len(chunk)
+        self.size += len(chunk)
+        evicted = self.evict()
+        if evicted:
+            await loop.run_in_executor(None, self.remove, evicted)
+
+    def write(self, name, chunk):
+        path = os.path.join(self.path, name)
+        # Written aside and renamed so readers never map a partial chunk
+        with open(path + '.tmp', 'wb') as f:
+            f.write(chunk)
+        os.replace(path + '.tmp', path)
+
+    def evict(self):
+        """Forget the least recently used chunks over the budget, their names are returned for removal"""
+        evicted = []
+        while self.size > self.max_bytes and self.files:
+            name, size = self.files.popitem(last=False)
+            self.size -= size
+            evicted.append(name)
+        return evicted
+
+    def remove(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+
+if STREAM_WORKER is None:
+    chunk_cache = ChunkCache(STREAM_CACHE_DIR, STREAM_CACHE_SIZE * 1024 * 1024)
+else:
+    # Each stream worker keeps its own share of the budget in its own directory
+    chunk_cache = ChunkCache(os.path.join(STREAM_CACHE_DIR, STREAM_WORKER), STREAM_CACHE_SIZE * 1024 * 1024 // STREAM_WORKERS)
@@ -1,20 +1,195 @@
-import math
-from typing import Union
+import time
+import asyncio
+import logging
+import aiofiles
+from collections import deque, defaultdict
 from pyrogram.types import Message
-from utils import temp
+from info import BIN_CHANNEL, STREAM_PREFETCH, STREAM_SESSIONS, STREAM_SESSION_CHECK, STREAM_FILES_CACHE_SIZE, STREAM_FILES_CACHE_TTL
+from utils import temp, TTLCache, SingleFlight
+from web.utils.chunk_cache import chunk_cache
 from pyrogram import Client, utils, raw
 from pyrogram.session import Session, Auth
-from pyrogram.errors import AuthBytesInvalid
+from pyrogram.errors import AuthBytesInvalid, FileReferenceExpired
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
 
+logger = logging.getLogger(__name__)
+
+# GetFile limits must be powers of two in this range with offset % limit == 0
+MIN_CHUNK = 4 * 1024
+MAX_CHUNK = 1024 * 1024
+
+
+def floor_chunk(size):
+    return 1 << (max(min(int(size), MAX_CHUNK), MIN_CHUNK).bit_length() - 1)
+
+
+class ChunkSizer:
+    """Picks GetFile sizes from the throughput and latency measured per DC.
+
+    The first part of a stream is about what the DC sends in one round trip so the
+    first byte comes quickly, later parts double up to MAX_CHUNK like TCP slow start.
+    """
+
+    def __init__(self, throughput=1024 * 1024, latency=0.2, weight=0.05):
+        self.default = (throughput, latency)
+        self.weight = weight
+        self.sums = {}
+
+    def record(self, dc_id, size, seconds):
+        # Exponentially weighted sums for fitting seconds = latency + size / throughput
+        sums = self.sums.get(dc_id, (0, 0, 0, 0, 0))
+        sample = (1, size, seconds, size * size, size * seconds)
+        self.sums[dc_id] = tuple(total * (1 - self.weight) + value for total, value in zip(sums, sample))
+
+    def estimate(self, dc_id):
+        """(throughput in bytes per second, latency in seconds) of a DC"""
+        if dc_id not in self.sums:
+            return self.default
+        n, x, y, xx, xy = self.sums[dc_id]
+        x, y, xx, xy = x / n, y / n, xx / n, xy / n
+        variance = xx - x * x
+        if variance > 0.01 * x * x:
+            slope = (xy - x * y) / variance
+            latency = y - slope * x
+            if slope > 0 and latency > 0:
+                return 1 / slope, latency
+        # All requests had about the same size, the split cannot be measured
+        latency = min(self.default[1], y / 2)
+        return x / (y - latency), latency
+
+    def get(self, dc_id, position, remaining, previous=None):
+        throughput, latency = self.estimate(dc_id)
+        size = previous * 2 if previous else throughput * latency
+        # No bigger than the rest of the range needs, and aligned on the position
+        size = min(size, 1 << max(remaining - 1, 1).bit_length())
+        if position:
+            size = min(size, position & -position)
+        return floor_chunk(size)
+
+
+chunk_sizes = ChunkSizer()
+
+
+async def create_media_session(client: Client, dc_id: int):
+    if dc_id != await client.storage.dc_id():
+        media_session = Session(
+            client, dc_id, await Auth(client, dc_id, await client.storage.test_mode()).create(),
+            await client.storage.test_mode(), is_media=True
+        )
+        await media_session.start()
+
+        for _ in range(3):
+            exported_auth = await client.invoke(
+                raw.functions.auth.ExportAuthorization(
+                    dc_id=dc_id
+                )
+            )
+
+            try:
+                await media_session.send(
+                    raw.functions.auth.ImportAuthorization(
+                        id=exported_auth.id,
+                        bytes=exported_auth.bytes
+                    )
+                )
+            except AuthBytesInvalid:
+                continue
+            else:
+                break
+        else:
+            await media_session.stop()
+            raise AuthBytesInvalid
+    else:
+        media_session = Session(
+            client, dc_id, await client.storage.auth_key(),
+            await client.storage.test_mode(), is_media=True
+        )
+        await media_session.start()
+
+    return media_session
+
+
+class MediaSessionPool:
+    """Up to `size` media sessions per DC, each stream borrows the least loaded one"""
+
+    def __init__(self, size, check_interval):
+        self.size = size
+        self.check_interval = check_interval
+        self.sessions = defaultdict(list)
+        self.load = {}
+        self.locks = defaultdict(asyncio.Lock)
+        self.unhealthy = set()
+        self.checker = None
+
+    async def acquire(self, client: Client, dc_id: int):
+        async with self.locks[dc_id]:
+            sessions = self.sessions[dc_id]
+            session = min(sessions, key=self.load.get, default=None)
+            # Only open another session when every existing one is busy
+            if session is None or (self.load[session] and len(sessions) < self.size):
+                session = await create_media_session(client, dc_id)
+                sessions.append(session)
+                self.load[session] = 0
+            self.load[session] += 1
+        if self.checker is None:
+            self.checker = asyncio.create_task(self.check_sessions())
+        return session
+
+    def release(self, session):
+        if session in self.load:
+            self.load[session] -= 1
+            if session in self.unhealthy and not self.load[session]:
+                self.unhealthy.discard(session)
+                asyncio.create_task(self.stop(session))
+
+    async def stop(self, session):
+        self.load.pop(session, None)
+        try:
+            await session.stop()
+        except Exception:
+            pass
+
+    async def check_sessions(self):
+        """Ping every session and drop the ones that stopped answering
+
+        A dropped session is no longer handed out, it is stopped once the
+        streams still using it are done.
+        """
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for dc_id, sessions in list(self.sessions.items()):
+                for session in list(sessions):
+                    try:
+                        await session.send(raw.functions.Ping(ping_id=0), timeout=10)
+                    except Exception as e:
+                        logger.warning(f"Dropping media session of DC {dc_id}: {e}")
+                        sessions.remove(session)
+                        if self.load.get(session):
+                            self.unhealthy.add(session)
+                        else:
+                            await self.stop(session)
+
+
+media_sessions = MediaSessionPool(STREAM_SESSIONS, STREAM_SESSION_CHECK)
+file_properties = TTLCache(STREAM_FILES_CACHE_SIZE, STREAM_FILES_CACHE_TTL)
+file_properties_flight = SingleFlight()
 
-async def chunk_size(length):
-    return 2 ** max(min(math.ceil(math.log2(length / 1024)), 10), 2) * 1024
 
+async def get_file_properties(message_id: int):
+    """FileId of a BIN_CHANNEL message with its size, mime type, name and location"""
 
-async def offset_fix(offset, chunksize):
-    offset -= offset % chunksize
-    return offset
+    async def fetch():
+        media_msg = await temp.BOT.get_messages(BIN_CHANNEL, message_id)
+        properties = await TGCustomYield.generate_file_properties(media_msg)
+        properties.location = await TGCustomYield.get_location(properties)
+        properties.message_id = message_id
+        file_properties.set(message_id, properties)
+        return properties
+
+    properties = file_properties.get(message_id)
+    if properties is None:
+        properties = await file_properties_flight.do(message_id, fetch)
+    return properties
 
 
 class TGCustomYield:
@@ -24,6 +199,7 @@ class TGCustomYield:
             generate_file_properties: returns the properties for a media on a specific message contained in FileId class.
             generate_media_session: returns the media session for the DC that contains the media file on the message.
             yield_file: yield a file from telegram servers for streaming.
+            download: write a file from telegram servers to disk in constant memory.
         """
         self.main_bot = temp.BOT
 
@@ -39,50 +215,9 @@ class TGCustomYield:
 
         return file_id_obj
 
-    async def generate_media_session(self, client: Client, msg: Message):
-        data = await self.generate_file_properties(msg)
-
-        media_session = client.media_sessions.get(data.dc_id, None)
-
-        if media_session is None:
-            if data.dc_id != await client.storage.dc_id():
-                media_session = Session(
-                    client, data.dc_id, await Auth(client, data.dc_id, await client.storage.test_mode()).create(),
-                    await client.storage.test_mode(), is_media=True
-                )
-                await media_session.start()
-
-                for _ in range(3):
-                    exported_auth = await client.invoke(
-                        raw.functions.auth.ExportAuthorization(
-                            dc_id=data.dc_id
-                        )
-                    )
-
-                    try:
-                        await media_session.send(
-                            raw.functions.auth.ImportAuthorization(
-                                id=exported_auth.id,
-                                bytes=exported_auth.bytes
-                            )
-                        )
-                    except AuthBytesInvalid:
-                        continue
-                    else:
-                        break
-                else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
-            else:
-                media_session = Session(
-                    client, data.dc_id, await client.storage.auth_key(),
-                    await client.storage.test_mode(), is_media=True
-                )
-                await media_session.start()
-
-            client.media_sessions[data.dc_id] = media_session
-
-        return media_session
+    async def generate_media_session(self, client: Client, data: FileId):
+        """The least loaded media session of the DC, give it back with media_sessions.release"""
+        return await media_sessions.acquire(client, data.dc_id)
 
     @staticmethod
     async def get_location(file_id: FileId):
@@ -128,85 +263,102 @@ class TGCustomYield:
 
         return location
 
-    async def yield_file(self, media_msg: Message, offset: int, first_part_cut: int,
-                         last_part_cut: int, part_count: int, chunk_size: int) -> Union[str, None]: #pylint: disable=unsubscriptable-object
+    async def yield_file(self, data: FileId, start: int, end: int):
+        """Yield the bytes from start to end, both included"""
         client = self.main_bot
-        data = await self.generate_file_properties(media_msg)
-        media_session = await self.generate_media_session(client, media_msg)
-
-        current_part = 1
-
-        location = await self.get_location(data)
-
-        r = await media_session.send(
-            raw.functions.upload.GetFile(
-                location=location,
-                offset=offset,
-                limit=chunk_size
-            ),
-        )
-
-        if isinstance(r, raw.types.upload.File):
-            while current_part <= part_count:
-                chunk = r.bytes
-                if not chunk:
-                    break
-                offset += chunk_size
-                if part_count == 1:
-                    yield chunk[first_part_cut:last_part_cut]
+        media_session = await self.generate_media_session(client, data)
+        location = data.location
+        stop = end + 1
+
+        async def get_part(part_offset, limit):
+            """The part and whether it came from Telegram rather than the cache"""
+            nonlocal location
+            block = part_offset - part_offset % MAX_CHUNK
+            cached = await chunk_cache.get(data.media_id, block)
+            if cached is not None:
+                return cached[part_offset - block:part_offset - block + limit], False
+            for retry in (False, True):
+                began = time.monotonic()
+                used = location
+                try:
+                    r = await media_session.send(
+                        raw.functions.upload.GetFile(
+                            location=used,
+                            offset=part_offset,
+                            limit=limit
+                        ),
+                    )
                     break
-                if current_part == 1:
-                    yield chunk[first_part_cut:]
-                if 1 < current_part <= part_count:
-                    yield chunk
-
-                r = await media_session.send(
-                    raw.functions.upload.GetFile(
-                        location=location,
-                        offset=offset,
-                        limit=chunk_size
-                    ),
-                )
-
-                current_part += 1
-
-    async def download_as_bytesio(self, media_msg: Message):
-        client = self.main_bot
-        data = await self.generate_file_properties(media_msg)
-        media_session = await self.generate_media_session(client, media_msg)
-
-        location = await self.get_location(data)
-
-        limit = 1024 * 1024
-        offset = 0
-
-        r = await media_session.send(
-            raw.functions.upload.GetFile(
-                location=location,
-                offset=offset,
-                limit=limit
-            )
-        )
-
-        if isinstance(r, raw.types.upload.File):
-            m_file = []
-            # m_file.name = file_name
-            while True:
-                chunk = r.bytes
-
+                except FileReferenceExpired:
+                    if retry:
+                        raise
+                    # The cached file reference went stale, the first part to notice drops it
+                    # and every part waits for the message to be fetched again once
+                    if location is used:
+                        file_properties.pop(data.message_id)
+                    location = (await get_file_properties(data.message_id)).location
+            chunk = r.bytes if isinstance(r, raw.types.upload.File) else b""
+            if chunk:
+                chunk_sizes.record(data.dc_id, len(chunk), time.monotonic() - began)
+            return chunk, True
+
+        # Parts are requested STREAM_PREFETCH ahead of the one being sent and
+        # queued in order, a part that arrives early waits in its task.
+        pending = deque()
+        # The first part gets the size the estimate picks and is aligned down to it,
+        # the bytes before start are cut off below, so a seek starts as fast as offset 0
+        first = chunk_sizes.get(data.dc_id, 0, stop - start)
+        position = start - start % first
+        limit = None
+
+        def prefetch():
+            nonlocal position, limit
+            while position < stop and len(pending) < STREAM_PREFETCH:
+                if position % MAX_CHUNK == 0 and chunk_cache.has(data.media_id, position):
+                    limit = MAX_CHUNK
+                elif limit is None:
+                    limit = first
+                else:
+                    limit = chunk_sizes.get(data.dc_id, position, stop - position, limit)
+                pending.append((position, asyncio.create_task(get_part(position, limit))))
+                position += limit
+
+        # The cache keeps whole MAX_CHUNK blocks whatever part sizes the stream
+        # used, parts fetched from the start of a block are joined until it is full
+        block = []
+        block_offset = filled = 0
+
+        try:
+            prefetch()
+            while pending:
+                part_offset, task = pending.popleft()
+                chunk, fetched = await task
+                prefetch()
                 if not chunk:
                     break
-
-                m_file.append(chunk)
-
-                offset += limit
-
-                r = await media_session.send(
-                    raw.functions.upload.GetFile(
-                        location=location,
-                        offset=offset,
-                        limit=limit
-                    )
-                )
-
-            return m_file
+                # Cut the view, not the bytes
+                yield memoryview(chunk)[max(start - part_offset, 0):stop - part_offset]
+                if not fetched or not chunk_cache.max_bytes:
+                    continue
+                if part_offset % MAX_CHUNK == 0:
+                    block, block_offset, filled = [], part_offset, 0
+                elif not block or part_offset != block_offset + filled:
+                    continue
+                block.append(chunk)
+                filled += len(chunk)
+                if filled >= min(MAX_CHUNK, data.file_size - block_offset):
+                    await chunk_cache.set(data.media_id, block_offset, b"".join(block))
+                    block = []
+        finally:
+            # The client went away or the file ended early
+            for part_offset, task in pending:
+                task.cancel()
+            media_sessions.release(media_session)
+
+    async def download(self, data: FileId, path: str):
+        """Write the whole file to path, at most STREAM_PREFETCH parts are held in memory"""
+        async with aiofiles.open(path, 'wb') as f:
+            # Each part is written before the next is taken, a slow disk slows the fetch
+            async for chunk in self.yield_file(data, 0, data.file_size - 1):
+                await f.write(chunk)
+        return path
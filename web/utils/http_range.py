@@ -0,0 +1,70 @@
+import re
+
+# More ranges than this are answered with the whole file
+MAX_RANGES = 16
+
+range_spec = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """Sorted and merged (start, end) byte ranges of a Range header, both ends included.
+
+    None means the whole file is sent, for a missing, malformed or non byte range header.
+    RangeNotSatisfiable is raised when none of the ranges overlaps the file.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        match = range_spec.match(part)
+        if not match or not any(match.groups()):
+            return None
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+        else:
+            # bytes=-N is the last N bytes of the file
+            if not int(last):
+                continue
+            start, end = max(size - int(last), 0), size - 1
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    if not ranges:
+        raise RangeNotSatisfiable
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged if len(merged) <= MAX_RANGES else None
+
+
+def if_range_matches(header, etag):
+    """A Range is honoured unless If-Range names another version of the file"""
+    return header is None or header.strip() == etag
+
+
+def multipart_ranges(ranges, size, content_type, boundary):
+    """Part headers of a multipart/byteranges body as (head, start, end), and the closing delimiter"""
+    parts = [
+        (
+            f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n".encode(),
+            start,
+            end
+        )
+        for start, end in ranges
+    ]
+    return parts, f"\r\n--{boundary}--\r\n".encode()
@@ -1,20 +1,75 @@
-from info import BIN_CHANNEL, URL
-from utils import temp
-from web.utils.custom_dl import TGCustomYield
+import os
+import re
+import time
 import urllib.parse
-import aiofiles
+from info import URL, STREAM_FILES_CACHE_SIZE, STREAM_FILES_CACHE_TTL
+from utils import TTLCache
+from web.utils.custom_dl import get_file_properties
+from web.utils.scheduler import watch_token
+
+
+class Template:
+    """A %s template read once and split into literal parts, reread when the file changes"""
+
+    def __init__(self, path, tag, check_interval=1):
+        self.path = path
+        self.tag = tag
+        self.check_interval = check_interval
+        self.checked = float('-inf')
+        self.mtime = None
+        self.parts = []
+
+    def refresh(self):
+        """Reload the template if it changed on disk, True when it was reloaded"""
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return False
+        self.checked = now
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.mtime:
+            return False
+        with open(self.path) as f:
+            text = f.read().replace('tag', self.tag)
+        # Literal text sits at even indexes, %s slots between them, %% is a literal %
+        pieces = re.split(r'%(.)', text)
+        parts = [pieces[0]]
+        for directive, literal in zip(pieces[1::2], pieces[2::2]):
+            if directive == '%':
+                parts[-1] += '%' + literal
+            else:
+                parts.append(literal)
+        self.parts = parts
+        self.mtime = mtime
+        return True
+
+    def render(self, *values):
+        html = [self.parts[0]]
+        for value, literal in zip(values, self.parts[1:]):
+            html.append(str(value))
+            html.append(literal)
+        return ''.join(html)
+
+
+watch_template = Template('web/template/watch.html', 'video')
+watch_template.refresh()
+watch_pages = TTLCache(STREAM_FILES_CACHE_SIZE, STREAM_FILES_CACHE_TTL)
 
 
 async def media_watch(message_id):
-    media_msg = await temp.BOT.get_messages(BIN_CHANNEL, message_id)
-    file_properties = await TGCustomYield().generate_file_properties(media_msg)
+    if watch_template.refresh():
+        watch_pages.clear()
+    html = watch_pages.get(message_id)
+    if html is not None:
+        return html
+    file_properties = await get_file_properties(message_id)
     file_name, mime_type = file_properties.file_name, file_properties.mime_type
-    src = urllib.parse.urljoin(URL, f'download/{message_id}')
+    # The player's requests carry a signed token to be served before downloads
+    src = urllib.parse.urljoin(URL, f'download/{message_id}?watch={watch_token(message_id)}')
     tag = mime_type.split('/')[0].strip()
     if tag == 'video':
-        async with aiofiles.open('web/template/watch.html') as r:
-            heading = 'Watch - {}'.format(file_name)
-            html = (await r.read()).replace('tag', tag) % (heading, file_name, src)
+        heading = 'Watch - {}'.format(file_name)
+        html = watch_template.render(heading, file_name, src)
     else:
         html = '<h1>This is not streamable file</h1>'
+    watch_pages.set(message_id, html)
     return html
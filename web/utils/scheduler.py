@@ -0,0 +1,149 @@
+import time
+import hmac
+import heapq
+import hashlib
+import asyncio
+import itertools
+from collections import defaultdict
+from info import BOT_TOKEN, STREAM_LIMIT, STREAM_LIMIT_PER_IP, STREAM_RATE, STREAM_RATE_PER_IP
+
+# Streams started by the watch page are admitted before downloads
+WATCH, DOWNLOAD = 0, 1
+# Long enough to watch a film from a watch page that was cached for a while
+WATCH_TOKEN_TTL = 6 * 3600
+
+
+def sign_watch(message_id, expires):
+    return hmac.new(BOT_TOKEN.encode(), f"watch:{message_id}:{expires}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def watch_token(message_id):
+    """Token the watch page puts in its player's URL, the server issues it so clients cannot pick WATCH themselves.
+
+    It is still readable in the page, so whoever copies it gets watch priority for that file until it expires.
+    """
+    expires = int(time.time()) + WATCH_TOKEN_TTL
+    return f"{expires:x}.{sign_watch(message_id, expires)}"
+
+
+def is_watch_token(message_id, token):
+    expires, _, signature = token.partition(".")
+    try:
+        expires = int(expires, 16)
+    except ValueError:
+        return False
+    return expires > time.time() and hmac.compare_digest(signature, sign_watch(message_id, expires))
+
+
+class TokenBucket:
+    """Limits the bytes per second of whoever consumes from it, up to one second of burst"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    async def consume(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Go into debt and sleep it off, concurrent consumers queue up behind each other
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class StreamScheduler:
+    """Admits streams by priority under global and per IP limits, and paces their bytes"""
+
+    def __init__(self, limit, limit_per_ip, rate, rate_per_ip):
+        self.limit = limit
+        self.limit_per_ip = limit_per_ip
+        self.rate_per_ip = rate_per_ip
+        self.bucket = TokenBucket(rate) if rate else None
+        self.ip_buckets = {}
+        self.active = defaultdict(int)
+        self.active_per_ip = defaultdict(int)
+        self.waiting = []
+        self.order = itertools.count()
+        self.sent = 0
+
+    def wake(self):
+        """Start waiting streams in priority order, those of IPs at their limit keep waiting"""
+        blocked = []
+        while self.waiting and sum(self.active.values()) < self.limit:
+            item = heapq.heappop(self.waiting)
+            priority, _, ip, future = item
+            if future.done():
+                continue
+            if self.active_per_ip[ip] >= self.limit_per_ip:
+                blocked.append(item)
+                continue
+            self.active[priority] += 1
+            self.active_per_ip[ip] += 1
+            future.set_result(None)
+        for item in blocked:
+            heapq.heappush(self.waiting, item)
+
+    async def acquire(self, ip, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.order), ip, future))
+        self.wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Cancelled after being admitted, give the slot back
+            if future.done() and not future.cancelled():
+                self.release(ip, priority)
+            raise
+
+    def release(self, ip, priority):
+        self.active[priority] -= 1
+        self.active_per_ip[ip] -= 1
+        if not self.active_per_ip[ip]:
+            del self.active_per_ip[ip]
+            self.ip_buckets.pop(ip, None)
+        self.wake()
+
+    def share(self, workers):
+        """Split the global limits between stream worker processes"""
+        self.limit = max(self.limit // workers, 1)
+        if self.bucket:
+            self.bucket = TokenBucket(self.bucket.rate / workers)
+
+    async def throttle(self, ip, priority, body):
+        """Wrap a response body, it waits for its turn and then sends at the allowed rate"""
+        await self.acquire(ip, priority)
+        try:
+            async for chunk in body:
+                if self.rate_per_ip:
+                    bucket = self.ip_buckets.setdefault(ip, TokenBucket(self.rate_per_ip))
+                    await bucket.consume(len(chunk))
+                if self.bucket:
+                    await self.bucket.consume(len(chunk))
+                self.sent += len(chunk)
+                yield chunk
+        finally:
+            await body.aclose()
+            self.release(ip, priority)
+
+    def metrics(self):
+        queued = defaultdict(int)
+        for priority, _, _, future in self.waiting:
+            if not future.done():
+                queued[priority] += 1
+        return {
+            'active': {'watch': self.active[WATCH], 'download': self.active[DOWNLOAD]},
+            'queued': {'watch': queued[WATCH], 'download': queued[DOWNLOAD]},
+            'clients': len(self.active_per_ip),
+            'sent_bytes': self.sent,
+            'limits': {
+                'streams': self.limit,
+                'streams_per_ip': self.limit_per_ip,
+                'rate': self.bucket.rate if self.bucket else 0,
+                'rate_per_ip': self.rate_per_ip
+            }
+        }
+
+
+stream_scheduler = StreamScheduler(STREAM_LIMIT, STREAM_LIMIT_PER_IP, STREAM_RATE * 1024, STREAM_RATE_PER_IP * 1024)
@@ -0,0 +1,121 @@
+"""Stream server worker process, bot.py starts STREAM_WORKERS of them.
+
+Each worker logs in with the session string exported by the bot, so no new
+authorization is made per start, and receives no updates. It opens its own
+media sessions and listens on PORT with SO_REUSEPORT so the kernel spreads
+connections between the workers. A worker exits once the bot process that
+started it is gone, it holds the other end of the worker's stdin.
+"""
+import os
+import sys
+import socket
+import asyncio
+import logging
+from aiohttp import web
+from pyrogram import Client
+from info import API_ID, API_HASH, PORT, STREAM_WORKERS, STREAM_WORKER, STREAM_SESSION
+from utils import temp
+from database.users_chats_db import db
+from web import web_app
+from web.utils.scheduler import stream_scheduler
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 10
+runner = None
+processes = set()
+
+
+async def main():
+    client = Client(
+        name=f'stream-worker-{STREAM_WORKER}',
+        api_id=API_ID,
+        api_hash=API_HASH,
+        session_string=STREAM_SESSION,
+        in_memory=True,
+        no_updates=True
+    )
+    await client.start()
+    temp.BOT = client
+    stream_scheduler.share(STREAM_WORKERS)
+
+    app = web.AppRunner(web_app)
+    await app.setup()
+    await web.TCPSite(app, "0.0.0.0", PORT, reuse_port=True).start()
+    logger.info(f"🌐 Stream worker {STREAM_WORKER} serving on port {PORT}")
+
+    # The pipe is closed on exec, so it also reaches EOF when the bot restarts itself
+    parent = asyncio.StreamReader()
+    await asyncio.get_running_loop().connect_read_pipe(lambda: asyncio.StreamReaderProtocol(parent), sys.stdin)
+    beat = asyncio.create_task(heartbeat(f'{socket.gethostname()}:{STREAM_WORKER}'))
+    try:
+        await parent.read()
+        logger.info(f"Stream worker {STREAM_WORKER} lost the bot process, stopping")
+    finally:
+        beat.cancel()
+        await app.cleanup()
+        await client.stop()
+
+
+async def heartbeat(worker):
+    while True:
+        try:
+            await db.update_stream_worker(worker, pid=os.getpid(), metrics=stream_scheduler.metrics())
+        except Exception as e:
+            logger.error(f"Failed to update worker heartbeat: {e}")
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+async def run_stream_workers(session_string):
+    """Start the stream worker processes from the bot and restart any that exits"""
+
+    async def run(worker):
+        env = dict(os.environ, STREAM_WORKER=str(worker), STREAM_SESSION=session_string)
+        while True:
+            process = await asyncio.create_subprocess_exec(sys.executable, '-m', 'web.worker', env=env, stdin=asyncio.subprocess.PIPE)
+            processes.add(process)
+            try:
+                code = await process.wait()
+            finally:
+                processes.discard(process)
+            logger.warning(f"Stream worker {worker} exited with code {code}, restarting")
+            await asyncio.sleep(5)
+
+    logger.info(f"🌐 Starting {STREAM_WORKERS} stream workers on port {PORT}")
+    await asyncio.gather(*(run(worker) for worker in range(STREAM_WORKERS)))
+
+
+def start_stream_workers(session_string):
+    """Start the stream worker processes unless they are already running"""
+    global runner
+    if runner is None or runner.done():
+        runner = asyncio.create_task(run_stream_workers(session_string))
+
+
+async def stop_stream_workers(timeout=10):
+    """Stop the stream worker processes and wait for them to exit, killing any that takes too long"""
+    if runner is not None:
+        runner.cancel()
+    stopping = list(processes)
+    for process in stopping:
+        if process.returncode is None:
+            process.terminate()
+    for process in stopping:
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'[%(asctime)s - %(levelname)s] - worker {STREAM_WORKER} - %(name)s - %(message)s',
+        datefmt='%d-%b-%y %H:%M:%S'
+    )
+    logging.getLogger("pyrogram").setLevel(logging.WARNING)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass